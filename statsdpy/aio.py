@@ -0,0 +1,603 @@
+from statsdpy.statsd import StatsdServer
+from collections import deque
+from functools import partial
+import Queue
+import socket
+import signal
+import errno
+import stat
+import time
+import os
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        raise ImportError("the asyncio engine needs asyncio (trollius on "
+                          "python 2)")
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# asyncio.async was renamed ensure_future
+ensure_future = getattr(asyncio, 'ensure_future', None) or \
+    getattr(asyncio, 'async')
+
+
+class CarbonProtocol(asyncio.Protocol):
+    """
+    Write side of a connection to carbon.
+
+    The transport's write buffer limit is 0, so writing is paused as soon as
+    anything gets buffered and resumed once all of it has been handed to the
+    kernel, which is how AsyncCarbonClient knows a batch has been sent.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.closed = False
+        self.paused = False
+        self.waiter = None
+        self.timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(0)
+
+    def data_received(self, data):
+        # carbon never talks back
+        pass
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._wake(None)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._wake(exc or IOError("connection closed"))
+
+    def wait_drained(self, callback, timeout):
+        """Call callback once writing resumes
+
+        :param callback: called with None, or with the error if the
+                         connection is lost or timeout seconds pass first
+        :param int timeout: seconds to wait
+        """
+        self.waiter = callback
+        self.timer = self.loop.call_later(timeout, self._wake,
+                                          asyncio.TimeoutError())
+
+    def _wake(self, err):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        waiter, self.waiter = self.waiter, None
+        if waiter:
+            waiter(err)
+
+
+class AsyncCarbonClient(object):
+    """
+    Long lived connection to a carbon listener, the asyncio counterpart of
+    CarbonClient.
+
+    Sends are queued and written one after the other over a single
+    connection which is kept open for the next send. A send that fails is
+    retried over a fresh connection, resuming at the first batch that wasn't
+    written.
+    """
+
+    def __init__(self, addr, loop, timeout=5, persistent=True, retries=1):
+        """
+        :param tuple addr: (host, port) of the carbon listener
+        :param loop: The event loop
+        :param int timeout: seconds allowed for each connect and send
+        :param bool persistent: keep the connection open between sends
+        :param int retries: times to reconnect and retry a failed send
+        """
+        self.addr = addr
+        self.loop = loop
+        self.timeout = timeout
+        self.persistent = persistent
+        self.retries = retries
+        self.protocol = None
+        self.queue = deque()
+        self.current = None
+        self.sent = 0
+        self.attempt = 0
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the connection and send statistics
+
+        :returns: dict of the statistics gathered since the last reset
+        """
+        stats = self.stats
+        self.stats = {'connects': 0, 'reconnects': 0, 'failures': 0,
+                      'connect_time': 0.0, 'sends': 0, 'send_time': 0.0,
+                      'send_time_max': 0.0, 'bytes': 0}
+        return stats
+
+    def send(self, batches):
+        """Queue batches to be written back to back
+
+        :param list batches: strings to send
+        :returns: future done once they're sent, or failed with the last
+                  error (or asyncio.TimeoutError) once out of retries
+        """
+        done = asyncio.Future(loop=self.loop)
+        self.queue.append((batches, done))
+        if self.current is None:
+            self._next()
+        return done
+
+    def _next(self):
+        self.current = None
+        if not self.queue:
+            return
+        self.current = self.queue.popleft()
+        self.sent = 0
+        self.attempt = 0
+        if self.protocol is None:
+            self._connect()
+        elif self.protocol.closed:
+            # carbon closed the idle connection on us
+            self.protocol = None
+            self._connect(reconnect=True)
+        else:
+            self._write()
+
+    def _connect(self, reconnect=False):
+        connecting = ensure_future(self.loop.create_connection(
+            partial(CarbonProtocol, self.loop), *self.addr), loop=self.loop)
+        timer = self.loop.call_later(self.timeout, connecting.cancel)
+        connecting.add_done_callback(partial(self._connected, time.time(),
+                                             reconnect, timer))
+
+    def _connected(self, start, reconnect, timer, connecting):
+        timer.cancel()
+        if connecting.cancelled():
+            return self._failed(asyncio.TimeoutError())
+        err = connecting.exception()
+        if err is not None:
+            return self._failed(err)
+        transport, self.protocol = connecting.result()
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stats['connects'] += 1
+        if reconnect:
+            self.stats['reconnects'] += 1
+        self.stats['connect_time'] += time.time() - start
+        self._write()
+
+    def _write(self):
+        batches = self.current[0]
+        protocol = self.protocol
+        while self.sent < len(batches):
+            if protocol.closed:
+                return self._failed(IOError("connection closed"))
+            batch = batches[self.sent]
+            start = time.time()
+            protocol.transport.write(batch)
+            if protocol.paused:
+                return protocol.wait_drained(
+                    partial(self._drained, start, len(batch)), self.timeout)
+            self._written(start, len(batch))
+        if not self.persistent:
+            protocol.transport.close()
+            self.protocol = None
+        done = self.current[1]
+        if not done.done():
+            done.set_result(None)
+        self._next()
+
+    def _drained(self, start, size, err):
+        if err is not None:
+            return self._failed(err)
+        self._written(start, size)
+        self._write()
+
+    def _written(self, start, size):
+        elapsed = time.time() - start
+        self.stats['sends'] += 1
+        self.stats['send_time'] += elapsed
+        self.stats['bytes'] += size
+        if elapsed > self.stats['send_time_max']:
+            self.stats['send_time_max'] = elapsed
+        self.sent += 1
+
+    def _failed(self, err):
+        self.stats['failures'] += 1
+        if self.protocol is not None:
+            self.protocol.transport.abort()
+            self.protocol = None
+        self.attempt += 1
+        if self.attempt <= self.retries:
+            return self._connect(reconnect=True)
+        done = self.current[1]
+        if not done.done():
+            done.set_exception(err)
+        self._next()
+
+    def close(self):
+        """Close the connection if it's idle"""
+        if self.current is None and self.protocol is not None:
+            self.protocol.transport.close()
+            self.protocol = None
+
+
+class StatsdProtocol(asyncio.DatagramProtocol):
+    """
+    Hand received datagrams to the server's batch parser.
+
+    Datagrams received in the same pass of the event loop are parsed as a
+    single batch of up to recv_batch_size datagrams.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.batch = []
+
+    def datagram_received(self, data, addr):
+        if not data:
+            return
+        batch = self.batch
+        batch.append(data)
+        if len(batch) == 1:
+            self.server.loop.call_soon(self.process)
+        elif len(batch) >= self.server.recv_batch_size:
+            self.process()
+
+    def process(self):
+        """Parse the datagrams received so far"""
+        batch = self.batch
+        if batch:
+            self.batch = []
+            server = self.server
+            server.recv_wakeups += 1
+            server.recv_datagrams += len(batch)
+            server.process_batch(batch)
+
+    def error_received(self, exc):
+        self.server.logger.critical("error receiving events: %s" % exc)
+
+
+class StreamProtocol(asyncio.Protocol):
+    """Hand the lines of a newline framed stream connection to the
+    server's batch parser"""
+
+    def __init__(self, server):
+        self.server = server
+        self.pending = ''
+
+    def connection_made(self, transport):
+        self.server.stream_connections += 1
+
+    def data_received(self, data):
+        self.server.recv_wakeups += 1
+        self.pending = self.server.process_stream(self.pending, data)
+
+    def connection_lost(self, exc):
+        if self.pending:
+            self.server.process_batch([self.pending])
+            self.pending = ''
+
+
+class AsyncioStatsdServer(StatsdServer):
+    """
+    Aggregating server running on an asyncio event loop (uvloop's when it's
+    installed) instead of eventlet.
+
+    Events go through the same batch parser, snapshots and payload builders
+    as with eventlet, so both engines report the same stats. Payloads are
+    built in an executor thread and sent by AsyncCarbonClient, everything
+    else runs as callbacks on the loop. Only a single process is supported.
+    """
+
+    def __init__(self, conf):
+        if uvloop and conf.get('uvloop', 'yes') in self.TRUE_VALUES:
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        StatsdServer.__init__(self, conf)
+        if self.workers > 1:
+            raise ValueError("the asyncio engine doesn't support workers")
+        if self.backends:
+            raise ValueError("the asyncio engine doesn't support output "
+                             "backends")
+        self.flush_queue = Queue.Queue()
+        self.sending = False
+
+    def add_carbon(self, dest, own_spool=False):
+        """Set up the connection, and spool if spooling is on, of a graphite
+        destination
+
+        :param tuple dest: The (host, port, instance) to send to
+        :param bool own_spool: spool under spool_dir/<host>_<port> rather
+                               than in spool_dir itself
+        """
+        StatsdServer.add_carbon(self, dest, own_spool)
+        self.carbons[dest] = AsyncCarbonClient(
+            dest[:2], self.loop, timeout=self.graphite_timeout,
+            persistent=self.conf.get('graphite_persistent', 'yes') in
+            self.TRUE_VALUES)
+
+    def _cooperative(self, iterable):
+        """Payloads are built outside of the loop, no need to yield"""
+        return iterable
+
+    def listen(self):
+        """Bind the udp listen socket and start receiving events"""
+        addr = (self.listen_addr, self.listen_port)
+        transport, protocol = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                partial(StatsdProtocol, self), local_addr=addr))
+        if self.recv_buffer_size:
+            transport.get_extra_info('socket').setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
+        self.logger.info("Listening on %s:%d" % addr)
+        if self.debug:
+            print "Listening on %s:%d" % addr
+        if self.tcp_listen_port:
+            addr = (self.listen_addr, self.tcp_listen_port)
+            self.loop.run_until_complete(self.loop.create_server(
+                partial(StreamProtocol, self), *addr))
+            self.logger.info("Listening on tcp %s:%d" % addr)
+            if self.debug:
+                print "Listening on tcp %s:%d" % addr
+        if self.unix_stream_socket:
+            self.loop.run_until_complete(self.loop.create_unix_server(
+                partial(StreamProtocol, self),
+                sock=self.unix_socket(self.unix_stream_socket,
+                                      socket.SOCK_STREAM)))
+        if self.unix_dgram_socket:
+            sock = self.unix_socket(self.unix_dgram_socket,
+                                    socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.loop.add_reader(sock.fileno(), self.drain, sock)
+        return transport
+
+    def unix_socket(self, path, kind):
+        """Create and bind a unix domain socket, replacing any socket left
+        at path by a previous run
+
+        :param str path: The path to bind to
+        :param int kind: socket.SOCK_DGRAM or socket.SOCK_STREAM
+        """
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, kind)
+        sock.bind(path)
+        self.logger.info("Listening on %s" % path)
+        if self.debug:
+            print "Listening on %s" % path
+        return sock
+
+    def drain(self, sock):
+        """Read and process up to recv_batch_size datagrams from a readable
+        non-blocking socket"""
+        batch = []
+        try:
+            while len(batch) < self.recv_batch_size:
+                data = sock.recv(self.max_datagram_size)
+                if data:
+                    batch.append(data)
+        except socket.error as err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.logger.critical("error receiving events: %s" % err)
+        self.recv_wakeups += 1
+        self.recv_datagrams += len(batch)
+        self.process_batch(batch)
+
+    def report_stats(self, payloads):
+        """
+        Start sending data to the graphite destinations
+
+        :param dict payloads: Destination to the list of strings (eg pickle
+                              batches) to send it back to back
+        :returns: list of futures, done once each destination's payload has
+                  been sent or spooled
+        """
+        return [self.send_payload(dest, payload)
+                for dest, payload in payloads.iteritems()]
+
+    def send_payload(self, dest, payload):
+        """
+        Start sending data to a graphite destination, spooling it if that
+        fails
+
+        :param tuple dest: The (host, port, instance) to send to
+        :param list payload: The strings to send back to back
+        :returns: future done once it's been sent or spooled
+        """
+        if self.debug:
+            if self.pickle_proto:
+                print "reporting pickled stats to %s:%d" % dest[:2]
+            else:
+                print "reporting stats to %s:%d -> {\n%s}" % \
+                    (dest[:2] + ("".join(payload),))
+        sending = self.carbons[dest].send(payload)
+        sending.add_done_callback(partial(self._payload_sent, dest, payload))
+        return sending
+
+    def _payload_sent(self, dest, payload, sending):
+        err = sending.exception()
+        if self.debug:
+            stats = self.carbons[dest].stats
+            print "graphite connects: %d reconnects: %d send time: " \
+                "%.3fs" % (stats['connects'], stats['reconnects'],
+                           stats['send_time'])
+        if err is None:
+            return
+        if isinstance(err, asyncio.TimeoutError):
+            self.logger.critical("Timeout sending to graphite %s:%d, giving "
+                                 "up" % dest[:2])
+            if self.debug:
+                print "Timeout talking to graphite %s:%d" % dest[:2]
+        else:
+            self.logger.critical("error connecting to graphite %s:%d: %s" %
+                                 (dest[:2] + (err,)))
+            if self.debug:
+                print "error connecting to graphite %s:%d: %s" % \
+                    (dest[:2] + (err,))
+        self.spool_payload(dest, payload)
+
+    def start_replayer(self, dest):
+        """Start replaying the spool of a destination in the background
+
+        :param tuple dest: The (host, port, instance) to replay to
+        """
+        self.spool_replayer(dest)
+
+    def spool_replayer(self, dest):
+        """
+        Replay the payloads spooled for a destination in
+        spool_retry_interval, oldest first and at most spool_replay_rate per
+        second, for as long as it takes them.
+
+        :param tuple dest: The (host, port, instance) to replay to
+        """
+        self.loop.call_later(self.spool_retry_interval, self._replay, dest)
+
+    def _replay(self, dest):
+        spool = self.spools[dest]
+        try:
+            data = spool.peek()
+        except Exception as err:
+            self.logger.critical("error replaying spool to %s:%d: %s, %d "
+                                 "payloads left" %
+                                 (dest[:2] + (err, spool.depth)))
+            data = None
+        if data is None:
+            return self.spool_replayer(dest)
+        replaying = self.carbons[dest].send([data])
+        replaying.add_done_callback(partial(self._replayed, dest))
+
+    def _replayed(self, dest, replaying):
+        spool = self.spools[dest]
+        err = replaying.exception()
+        if err is None:
+            spool.pop()
+            self.loop.call_later(1.0 / self.spool_replay_rate, self._replay,
+                                 dest)
+            return
+        if isinstance(err, asyncio.TimeoutError):
+            self.logger.critical("Timeout replaying spool to %s:%d, %d "
+                                 "payloads left" %
+                                 (dest[:2] + (spool.depth,)))
+        else:
+            self.logger.critical("error replaying spool to %s:%d: %s, %d "
+                                 "payloads left" %
+                                 (dest[:2] + (err, spool.depth)))
+        self.spool_replayer(dest)
+
+    def stats_flush(self):
+        """
+        Take a snapshot every flush_interval and queue it for flush_sender
+        """
+        if self.stopping:
+            return
+        self.loop.call_later(self.flush_interval, self.stats_flush)
+        try:
+            if self.debug:
+                print "seen %d stats so far." % self.stats_seen
+                print "current counters: %s" % self.counters
+            if self.flush_queue.qsize():
+                self.logger.warning("%d flushes still waiting to be sent"
+                                    % self.flush_queue.qsize())
+            snapshot = self.take_snapshot()
+            if self.debug:
+                print "internal stats: %s" % snapshot['internal']
+            self.flush_queue.put(snapshot)
+            for rolled_up in self.roll_up(snapshot):
+                self.flush_queue.put(rolled_up)
+            if not self.sending:
+                self.flush_sender()
+        except: # safety net
+            self.logger.critical('Encountered error in stats_flush loop')
+
+    def flush_sender(self):
+        """
+        Build the payload of the next queued snapshot in an executor thread,
+        so the loop keeps receiving events meanwhile, then send it
+        """
+        snapshot = self.flush_queue.get_nowait()
+        self.sending = True
+        if self.pickle_proto:
+            build = self.pickle_payload
+        else:
+            build = self.plain_payload
+        building = self.loop.run_in_executor(None, build, snapshot)
+        building.add_done_callback(partial(self._built, snapshot))
+
+    def _built(self, snapshot, building):
+        sending = []
+        try:
+            payloads = building.result()
+            batches = [batch for payload in payloads.itervalues()
+                       for batch in payload]
+            flush_stats = snapshot.get('window', self.window).flush_stats
+            flush_stats['batches'] = len(batches)
+            flush_stats['payload_bytes'] = \
+                sum(len(batch) for batch in batches)
+            sending = self.report_stats(payloads)
+        except: # safety net
+            self.logger.critical('Encountered error in flush_sender loop')
+        if sending:
+            asyncio.gather(*sending, return_exceptions=True) \
+                .add_done_callback(partial(self._sent, snapshot))
+        else:
+            self._sent(snapshot)
+
+    def _sent(self, snapshot, sending=None):
+        if 'window' not in snapshot:
+            self.recycle_timers(snapshot['timers'])
+        self.sending = False
+        if self.flush_queue.qsize():
+            self.flush_sender()
+        elif self.stopping:
+            self.loop.stop()
+
+    def shutdown(self):
+        """
+        Flush (or checkpoint) what was aggregated since the last flush, and
+        stop the loop once every queued flush has been sent or
+        shutdown_timeout seconds have passed.
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        self.logger.info("shutting down")
+        try:
+            for snapshot in self.final_snapshots():
+                self.flush_queue.put(snapshot)
+        except: # safety net
+            self.logger.critical('Encountered error shutting down')
+        self.loop.call_later(self.shutdown_timeout, self.loop.stop)
+        if not self.sending:
+            if self.flush_queue.qsize():
+                self.flush_sender()
+            else:
+                self.loop.stop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.restore_state()
+        self.listen()
+        self.loop.add_signal_handler(signal.SIGTERM, self.shutdown)
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+        self.loop.add_signal_handler(signal.SIGUSR2, self.logger.warning,
+                                     "handing over to a new process takes "
+                                     "the eventlet engine")
+        self.loop.call_later(self.flush_interval, self.stats_flush)
+        for dest in self.spools:
+            self.start_replayer(dest)
+        self.loop.run_forever()
@@ -0,0 +1,344 @@
+import eventlet
+import eventlet.queue
+from eventlet.green import socket, httplib
+from urlparse import urlsplit
+import time
+import zlib
+import os
+
+
+class Backend(object):
+    """
+    An output reported to every flush besides graphite, eg another time
+    series database or an archive.
+
+    Backends are handed the (name, value) of every metric of a snapshot,
+    built once for all of them from the metric names cached per flush
+    window, and serialize them into batches in their own format. Every
+    backend queues up to queue_size flushes, serializes them in a green
+    thread of its own and sends the batches from concurrency green threads,
+    so a slow or dead backend holds up neither graphite nor the other
+    backends. Flushes coming in while the queue is full are dropped.
+
+    Subclasses implement send(), and override line or serialize() for their
+    format.
+    """
+
+    #: format of a metric's line, given its name, value and the timestamp
+    line = '%s %s %d\n'
+    #: default number of metrics per batch
+    batch_size = 1000
+
+    def __init__(self, name, options, logger):
+        """
+        :param str name: The name of the backend, for its stats and logs
+        :param dict options: The backend_<name>_* options, without the
+                             prefix
+        :param logger: The logger to report failures to
+        """
+        self.name = name
+        self.logger = logger
+        self.batch_size = int(options.get('batch_size', self.batch_size))
+        self.concurrency = int(options.get('concurrency', 1))
+        self.flushes = eventlet.queue.Queue(int(options.get('queue_size',
+                                                            2)))
+        self.batches = eventlet.queue.Queue(self.concurrency)
+        self.failing = False
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the send statistics
+
+        :returns: dict of the statistics gathered since the last reset
+        """
+        stats = self.stats
+        self.stats = {'flushes': 0, 'dropped': 0, 'batches': 0,
+                      'failures': 0, 'bytes': 0, 'send_time': 0.0}
+        return stats
+
+    def start(self):
+        """Start serializing and sending queued flushes"""
+        eventlet.spawn_n(self._serializer)
+        for i in xrange(self.concurrency):
+            eventlet.spawn_n(self._sender)
+
+    def submit(self, tstamp, items):
+        """Queue a flush for sending, or drop it if the queue is full
+
+        :param int tstamp: The timestamp for the data points
+        :param list items: The (name, value) of every metric of the flush
+        """
+        try:
+            self.flushes.put_nowait((tstamp, items))
+            self.stats['flushes'] += 1
+        except eventlet.queue.Full:
+            self.stats['dropped'] += 1
+            self.logger.warning("backend %s is %d flushes behind, dropping "
+                                "one" % (self.name, self.flushes.qsize()))
+
+    def join(self):
+        """Wait for every queued flush to be sent (or to fail)"""
+        self.flushes.join()
+        self.batches.join()
+
+    def serialize(self, tstamp, items):
+        """Yield the batches to send a flush as, batch_size metrics each
+
+        :param int tstamp: The timestamp for the data points
+        :param list items: The (name, value) of every metric of the flush
+        """
+        line = self.line
+        for i in xrange(0, len(items), self.batch_size):
+            yield "".join([line % (name, value, tstamp) for name, value in
+                           items[i:i + self.batch_size]])
+
+    def send(self, batch):
+        """Send a batch
+
+        :param batch: A batch yielded by serialize
+        :returns: the number of bytes sent
+        :raises: whatever error kept the batch from being sent
+        """
+        raise NotImplementedError()
+
+    def _serializer(self):
+        while True:
+            tstamp, items = self.flushes.get()
+            try:
+                for batch in self.serialize(tstamp, items):
+                    # blocks while all senders are busy
+                    self.batches.put(batch)
+                    eventlet.sleep(0)
+            except Exception as err:
+                self.logger.critical("error serializing for backend %s: %s"
+                                     % (self.name, err))
+            self.flushes.task_done()
+
+    def _sender(self):
+        while True:
+            batch = self.batches.get()
+            start = time.time()
+            try:
+                self.stats['bytes'] += self.send(batch)
+                self.stats['batches'] += 1
+                if self.failing:
+                    self.failing = False
+                    self.logger.info("backend %s is back" % self.name)
+            except (Exception, eventlet.Timeout) as err:
+                self.stats['failures'] += 1
+                # once per outage rather than for every batch
+                if not self.failing:
+                    self.failing = True
+                    self.logger.critical("error sending to backend %s: %s" %
+                                         (self.name, err))
+            self.stats['send_time'] += time.time() - start
+            self.batches.task_done()
+
+
+class CarbonUDPBackend(Backend):
+    """
+    Carbon's plaintext protocol over udp (carbon's ENABLE_UDP_LISTENER).
+    Fire and forget: lines are packed into datagrams of up to packet_size
+    bytes and whatever gets lost on the way is lost for good.
+    """
+
+    #: default number of datagrams per batch
+    batch_size = 64
+
+    def __init__(self, name, options, logger):
+        Backend.__init__(self, name, options, logger)
+        self.addr = (options.get('host', '127.0.0.1'),
+                     int(options.get('port', '2003')))
+        self.packet_size = int(options.get('packet_size', '1400'))
+        self.sock = None
+
+    def serialize(self, tstamp, items):
+        """Yield lists of up to batch_size datagrams"""
+        line = self.line
+        size = self.packet_size
+        packets = []
+        packet = []
+        length = 0
+        for name, value in items:
+            data = line % (name, value, tstamp)
+            if packet and length + len(data) > size:
+                packets.append("".join(packet))
+                if len(packets) == self.batch_size:
+                    yield packets
+                    packets = []
+                packet = []
+                length = 0
+            packet.append(data)
+            length += len(data)
+        if packet:
+            packets.append("".join(packet))
+        if packets:
+            yield packets
+
+    def send(self, packets):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.connect(self.addr)
+        sent = 0
+        for packet in packets:
+            sent += self.sock.send(packet)
+        return sent
+
+
+class InfluxDBBackend(Backend):
+    """
+    InfluxDB's line protocol over http, every metric a measurement of its
+    own with a single value field. Batches of batch_size lines are gzipped
+    (unless gzip_level is 0) and POSTed to url over up to concurrency keep
+    alive connections.
+
+    Metric names only hold [a-zA-Z0-9_.-] besides the configured prefixes,
+    so they need no escaping.
+    """
+
+    line = '%s value=%s %d000000000\n'
+    batch_size = 5000
+
+    def __init__(self, name, options, logger):
+        Backend.__init__(self, name, options, logger)
+        url = urlsplit(options.get('url',
+                                   'http://127.0.0.1:8086/write?db=statsd'))
+        if url.scheme == 'https':
+            self.connection = httplib.HTTPSConnection
+        elif url.scheme == 'http':
+            self.connection = httplib.HTTPConnection
+        else:
+            raise ValueError("backend %s needs an http or https url" % name)
+        self.netloc = url.netloc
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        self.timeout = int(options.get('timeout', '5'))
+        self.gzip_level = int(options.get('gzip_level', '6'))
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.gzip_level:
+            self.headers['Content-Encoding'] = 'gzip'
+        if options.get('token'):
+            self.headers['Authorization'] = 'Token %s' % options['token']
+        self.idle = []
+
+    def serialize(self, tstamp, items):
+        """Yield the request bodies, gzipped unless gzip_level is 0"""
+        for body in Backend.serialize(self, tstamp, items):
+            if self.gzip_level:
+                # wbits 31 makes a gzip stream rather than a zlib one
+                gzipper = zlib.compressobj(self.gzip_level, zlib.DEFLATED,
+                                           31)
+                body = gzipper.compress(body) + gzipper.flush()
+            yield body
+
+    def send(self, body):
+        while True:
+            fresh = not self.idle
+            conn = self.connection(self.netloc, timeout=self.timeout) \
+                if fresh else self.idle.pop()
+            try:
+                with eventlet.Timeout(self.timeout):
+                    conn.request('POST', self.path, body, self.headers)
+                    response = conn.getresponse()
+                    detail = response.read()
+            except eventlet.Timeout:
+                conn.close()
+                raise
+            except Exception:
+                conn.close()
+                if fresh:
+                    raise
+                # influxdb closed the idle connection, try the next one
+                continue
+            self.idle.append(conn)
+            if response.status // 100 != 2:
+                raise IOError("%d %s: %s" % (response.status, response.reason,
+                                             detail[:200].strip()))
+            return len(body)
+
+
+class FileBackend(Backend):
+    """
+    Carbon plaintext lines appended to a local file, for archival. The file
+    is rotated to path.<time of the rotation> once it's max_bytes big or
+    rotate_interval seconds old, and the oldest rotated files are removed
+    past max_files of them (0 keeps them all).
+    """
+
+    batch_size = 10000
+
+    def __init__(self, name, options, logger):
+        Backend.__init__(self, name, options, logger)
+        if not options.get('path'):
+            raise ValueError("backend %s needs a path" % name)
+        self.path = os.path.abspath(options['path'])
+        self.max_bytes = int(options.get('max_bytes', '104857600'))
+        self.rotate_interval = int(options.get('rotate_interval', '86400'))
+        self.max_files = int(options.get('max_files', '0'))
+        self.file = None
+
+    def _open(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.file = open(self.path, 'a')
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        self.opened = time.time()
+
+    def rotate(self):
+        """Move the current file aside and remove the oldest rotated ones"""
+        self.file.close()
+        self.file = None
+        rotated = '%s.%s' % (self.path, time.strftime('%Y%m%d%H%M%S'))
+        suffix = 0
+        while os.path.exists(rotated + ('-%d' % suffix if suffix else '')):
+            suffix += 1
+        os.rename(self.path, rotated + ('-%d' % suffix if suffix else ''))
+        if self.max_files:
+            dirname, basename = os.path.split(self.path)
+            old = sorted(name for name in os.listdir(dirname)
+                         if name.startswith(basename + '.'))
+            for name in old[:-self.max_files]:
+                os.remove(os.path.join(dirname, name))
+
+    def send(self, batch):
+        if self.file is None:
+            self._open()
+        elif self.size >= self.max_bytes or \
+                (self.rotate_interval and
+                 time.time() - self.opened >= self.rotate_interval):
+            self.rotate()
+            self._open()
+        self.file.write(batch)
+        self.file.flush()
+        self.size += len(batch)
+        return len(batch)
+
+
+#: the types of backend_<name>_type, besides the dotted path of a Backend
+BACKENDS = {'carbon_udp': CarbonUDPBackend,
+            'influxdb': InfluxDBBackend,
+            'file': FileBackend}
+
+
+def make_backend(name, options, logger):
+    """Return the backend for a backend_<name>_* section of the config
+
+    :param str name: The name of the backend
+    :param dict options: The backend_<name>_* options, without the prefix,
+                         its type (defaulting to the name) is one of
+                         BACKENDS or the dotted path of a Backend subclass
+    :param logger: The logger to report failures to
+    """
+    kind = options.get('type', name)
+    if kind in BACKENDS:
+        backend = BACKENDS[kind]
+    elif '.' in kind:
+        module, attr = kind.rsplit('.', 1)
+        backend = getattr(__import__(module, fromlist=[attr]), attr)
+    else:
+        raise ValueError("unknown type %r for backend %s" % (kind, name))
+    return backend(name, options, logger)
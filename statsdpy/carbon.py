@@ -0,0 +1,120 @@
+import eventlet
+from eventlet.green import socket
+from eventlet.semaphore import Semaphore
+import select
+import time
+
+
+class CarbonClient(object):
+    """
+    Long lived (optionally pooled) connections to a carbon listener.
+
+    Payloads are written back to back over a single connection which is
+    kept open for the next send. A send that fails because the connection
+    went away is retried once over a fresh connection, resuming at the
+    first batch that wasn't written.
+    """
+
+    def __init__(self, addr, timeout=5, pool_size=1, persistent=True,
+                 retries=1):
+        """
+        :param tuple addr: (host, port) of the carbon listener
+        :param int timeout: seconds allowed for each connect and send
+        :param int pool_size: max number of concurrent connections
+        :param bool persistent: keep connections open between sends
+        :param int retries: times to reconnect and retry a failed send
+        """
+        self.addr = addr
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.persistent = persistent
+        self.retries = retries
+        self.slots = Semaphore(pool_size)
+        self.idle = []
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the connection and send statistics
+
+        :returns: dict of the statistics gathered since the last reset
+        """
+        stats = self.stats
+        self.stats = {'connects': 0, 'reconnects': 0, 'failures': 0,
+                      'connect_time': 0.0, 'sends': 0, 'send_time': 0.0,
+                      'send_time_max': 0.0, 'bytes': 0}
+        return stats
+
+    def _connect(self, reconnect=False):
+        start = time.time()
+        sock = socket.socket()
+        try:
+            with eventlet.Timeout(self.timeout):
+                sock.connect(self.addr)
+        except:
+            sock.close()
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stats['connects'] += 1
+        if reconnect:
+            self.stats['reconnects'] += 1
+        self.stats['connect_time'] += time.time() - start
+        return sock
+
+    def _checkout(self):
+        """Get an idle connection that carbon hasn't closed on us"""
+        if self.idle:
+            sock = self.idle.pop()
+            # carbon never talks back, so readable means EOF or an error
+            if not select.select([sock.fileno()], [], [], 0)[0]:
+                return sock
+            sock.close()
+            return self._connect(reconnect=True)
+        return self._connect()
+
+    def send(self, batches):
+        """Write batches back to back over a pooled connection
+
+        :param list batches: strings to send
+        :raises: the last error (or eventlet.Timeout) once out of retries
+        """
+        with self.slots:
+            sock = None
+            sent = 0
+            attempt = 0
+            while True:
+                try:
+                    if sock is None:
+                        if attempt:
+                            sock = self._connect(reconnect=True)
+                        else:
+                            sock = self._checkout()
+                    while sent < len(batches):
+                        start = time.time()
+                        with eventlet.Timeout(self.timeout):
+                            sock.sendall(batches[sent])
+                        elapsed = time.time() - start
+                        self.stats['sends'] += 1
+                        self.stats['send_time'] += elapsed
+                        self.stats['bytes'] += len(batches[sent])
+                        if elapsed > self.stats['send_time_max']:
+                            self.stats['send_time_max'] = elapsed
+                        sent += 1
+                    break
+                except (Exception, eventlet.Timeout):
+                    self.stats['failures'] += 1
+                    if sock is not None:
+                        sock.close()
+                        sock = None
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+            if self.persistent:
+                self.idle.append(sock)
+            else:
+                sock.close()
+
+    def close(self):
+        """Close all idle connections"""
+        while self.idle:
+            self.idle.pop().close()
@@ -120,7 +120,15 @@ class Daemon:
         file(self.pidfile, 'w+').write("%s\n" % pid)
 
     def delpid(self):
-        os.remove(self.pidfile)
+        # unless the daemon we handed over to already claimed it
+        try:
+            pidfile = file(self.pidfile, 'r')
+            pid = int(pidfile.read().strip())
+            pidfile.close()
+        except (IOError, ValueError):
+            return
+        if pid == os.getpid():
+            os.remove(self.pidfile)
 
     def start(self, *args, **kw):
         """
@@ -143,6 +151,14 @@ class Daemon:
         self.daemonize()
         self.run(*args, **kw)
 
+    def take_over(self, *args, **kw):
+        """
+        Start the daemon in place of the one in the pidfile, which started
+        us and is on its way out
+        """
+        self.daemonize()
+        self.run(*args, **kw)
+
     def stop(self):
         """
         Stop the daemon
@@ -0,0 +1,65 @@
+from hashlib import md5
+import bisect
+
+
+class ConsistentHashRing(object):
+    """
+    Consistent hash ring, compatible with the one carbon-relay uses for its
+    consistent-hashing relay method.
+
+    Nodes are identified by a key (carbon uses a (host, instance) tuple),
+    every node gets replica_count positions on the ring, and a metric is
+    owned by the first node at or after the position of its name. Adding or
+    removing a node only moves the metrics that node owns (or will own).
+    """
+
+    def __init__(self, nodes=(), replica_count=100):
+        """
+        :param nodes: initial node keys
+        :param int replica_count: number of ring positions per node
+        """
+        self.replica_count = replica_count
+        self.ring = []
+        self.nodes = set()
+        for node in nodes:
+            self.add_node(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def compute_ring_position(self, key):
+        return int(md5(str(key)).hexdigest()[:4], 16)
+
+    def add_node(self, node):
+        """Add a node to the ring
+
+        :param node: The node's key
+        """
+        self.nodes.add(node)
+        taken = set(position for position, owner in self.ring)
+        for i in xrange(self.replica_count):
+            position = self.compute_ring_position("%s:%d" % (node, i))
+            while position in taken:
+                position += 1
+            taken.add(position)
+            bisect.insort(self.ring, (position, node))
+
+    def remove_node(self, node):
+        """Remove a node from the ring
+
+        :param node: The node's key
+        """
+        self.nodes.discard(node)
+        self.ring = [entry for entry in self.ring if entry[1] != node]
+
+    def get_node(self, key):
+        """Return the node owning key
+
+        :param str key: A metric name
+        :returns: the node's key, or None if the ring is empty
+        """
+        if not self.ring:
+            return None
+        position = self.compute_ring_position(key)
+        index = bisect.bisect_left(self.ring, (position, ())) % len(self.ring)
+        return self.ring[index][1]
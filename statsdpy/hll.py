@@ -0,0 +1,123 @@
+from hashlib import md5
+import struct
+import math
+
+HASH = struct.Struct("<Q")
+
+
+class HyperLogLog(object):
+    """
+    Fixed size estimator of the number of distinct values added to it.
+
+    Each value's 64 bit hash picks one of 2 ** precision registers with its
+    first precision bits, the register keeps the highest rank (position of
+    the first 1 bit) seen in the remaining bits. The standard error of the
+    estimate is about 1.04 / sqrt(2 ** precision), i.e. 0.81% at the default
+    precision of 14, which takes 16KB of registers. Two estimators of the
+    same precision merge by keeping the highest of each register.
+    """
+
+    def __init__(self, precision=14):
+        """
+        :param int precision: number of bits picking the register, 4 to 16
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.size = 1 << precision
+        self.rank_bits = 64 - precision
+        self.rank_mask = (1 << self.rank_bits) - 1
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        """Add a value
+
+        :param str value: The value to add
+        """
+        hashed = HASH.unpack(md5(value).digest()[:8])[0]
+        index = hashed >> self.rank_bits
+        rank = self.rank_bits - (hashed & self.rank_mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """Merge in the registers of another estimator of the same precision
+
+        :param HyperLogLog other: The estimator to merge
+        """
+        if other.precision != self.precision:
+            raise ValueError("can't merge estimators of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def cardinality(self):
+        """Return the estimated number of distinct values added"""
+        size = self.size
+        registers = self.registers
+        if size >= 128:
+            alpha = 0.7213 / (1 + 1.079 / size)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[size]
+        harmonic = sum(registers.count(chr(rank)) * 2.0 ** -rank
+                       for rank in xrange(self.rank_bits + 2))
+        estimate = alpha * size * size / harmonic
+        zeros = registers.count('\x00')
+        if estimate <= 2.5 * size and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = size * math.log(size / float(zeros))
+        return estimate
+
+
+class UniqueSet(object):
+    """
+    Counter of the distinct values of a set metric.
+
+    Values are kept in a plain set, so they are counted exactly, until there
+    are more than max_exact of them. From then on they are counted in a
+    HyperLogLog, whose memory use no longer grows with the number of values.
+    """
+
+    def __init__(self, max_exact=1000, precision=14):
+        """
+        :param int max_exact: max number of values to count exactly
+        :param int precision: precision of the HyperLogLog taking over
+        """
+        self.max_exact = max_exact
+        self.precision = precision
+        self.values = set()
+        self.hll = None
+
+    def __len__(self):
+        if self.hll is None:
+            return len(self.values)
+        return int(round(self.hll.cardinality()))
+
+    def _switch(self):
+        self.hll = HyperLogLog(self.precision)
+        for value in self.values:
+            self.hll.add(value)
+        self.values = None
+
+    def add(self, value):
+        """Add a value
+
+        :param str value: The value to add
+        """
+        if self.hll is not None:
+            self.hll.add(value)
+            return
+        self.values.add(value)
+        if len(self.values) > self.max_exact:
+            self._switch()
+
+    def update(self, other):
+        """Merge in the values counted by another UniqueSet
+
+        :param UniqueSet other: The set to merge
+        """
+        if other.hll is None:
+            for value in other.values:
+                self.add(value)
+            return
+        if self.hll is None:
+            self._switch()
+        self.hll.update(other.hll)
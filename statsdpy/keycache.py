@@ -0,0 +1,50 @@
+_missing = object()
+
+
+class KeyCache(object):
+    """
+    Bounded cache of raw metric keys to their processed form.
+
+    LRU is approximated with two generations of plain dicts: keys are added
+    to the young generation and once that holds half of max_size keys it
+    replaces the old generation, which is thrown away. A key found in the
+    old generation is moved back into the young one, so keys seen recently
+    survive while a flood of new keys can never grow the cache past
+    max_size.
+    """
+
+    def __init__(self, resolve, max_size=10000):
+        """
+        :param resolve: callable turning a raw key into its processed form
+        :param int max_size: max number of keys to hold
+        """
+        self.resolve = resolve
+        self.generation_size = max(max_size // 2, 1)
+        self.young = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    def get(self, raw):
+        """Return the processed form of a raw key
+
+        :param str raw: The key as received
+        """
+        value = self.young.get(raw, _missing)
+        if value is not _missing:
+            self.hits += 1
+            return value
+        value = self.old.get(raw, _missing)
+        if value is _missing:
+            self.misses += 1
+            value = self.resolve(raw)
+        else:
+            self.hits += 1
+        if len(self.young) >= self.generation_size:
+            self.old = self.young
+            self.young = {}
+        self.young[raw] = value
+        return value
@@ -0,0 +1,190 @@
+import eventlet
+from eventlet.green import socket
+from statsdpy.statsd import StatsdServer, parse_destinations
+from statsdpy.hashring import ConsistentHashRing
+from statsdpy.keycache import KeyCache
+import errno
+
+
+class StatsdRelay(StatsdServer):
+    """
+    Forward events to a ring of downstream statsdpy instances.
+
+    Each event is sent to the instance owning its (sanitized) key on a
+    consistent hash ring, so all events for a key, and in particular all
+    samples of a timer, get aggregated by the same instance. Events for the
+    same instance are repacked into datagrams of up to relay_packet_size
+    bytes. Instances that refuse our datagrams are taken off the ring until
+    a health check finds them back up.
+    """
+
+    def __init__(self, conf):
+        StatsdServer.__init__(self, conf)
+        self.destinations = [
+            (host, port) for host, port, instance in
+            parse_destinations(conf.get('relay_destinations', ''))]
+        if not self.destinations:
+            raise ValueError("relay mode needs relay_destinations")
+        self.packet_size = int(conf.get('relay_packet_size', '1432'))
+        self.check_interval = float(conf.get('relay_check_interval', '5'))
+        self.replica_count = int(conf.get('relay_ring_replicas', '100'))
+        self.route_cache_size = int(conf.get('key_cache_size', '10000'))
+        self.socks = {}
+        for addr in self.destinations:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # connected, so the kernel tells us when nobody's listening
+            sock.connect(addr)
+            self.socks[addr] = sock
+        self.down = set()
+        self.forwarded = dict.fromkeys(self.destinations, 0)
+        self.dropped = 0
+        self.build_ring()
+
+    def build_ring(self):
+        """(Re)build the ring from the destinations that are up"""
+        self.ring = ConsistentHashRing(
+            [addr for addr in self.destinations if addr not in self.down],
+            replica_count=self.replica_count)
+        # routes cached for the old ring are no longer valid
+        if self.route_cache_size:
+            self.route = KeyCache(self.route_key, self.route_cache_size).get
+        else:
+            self.route = self.route_key
+
+    def route_key(self, raw):
+        """Return the destination for a raw key, None if all are down"""
+        return self.ring.get_node(self.sanitize_key(raw))
+
+    def mark_down(self, addr):
+        self.logger.critical("relay destination %s:%d is down" % addr)
+        if self.debug:
+            print "relay destination %s:%d is down" % addr
+        self.down.add(addr)
+        self.build_ring()
+
+    def mark_up(self, addr):
+        self.logger.info("relay destination %s:%d is back up" % addr)
+        if self.debug:
+            print "relay destination %s:%d is back up" % addr
+        self.down.discard(addr)
+        self.build_ring()
+
+    def process_batch(self, datagrams):
+        """
+        Relay every line of a batch of datagrams.
+
+        :param list datagrams: The datagrams to relay
+        """
+        metrics = [metric for data in datagrams
+                   for metric in data.splitlines() if metric]
+        self.lines_received += len(metrics)
+        self.relay(metrics)
+
+    def relay(self, metrics):
+        """
+        Route lines to their destinations and forward them.
+
+        :param list metrics: The lines to relay
+        """
+        route = self.route
+        outgoing = {}
+        for metric in metrics:
+            raw_key, sep, rest = metric.partition(':')
+            if not sep:
+                self.bad_line('invalid')
+                continue
+            addr = route(raw_key)
+            if addr is None:
+                self.dropped += 1
+            elif addr in outgoing:
+                outgoing[addr].append(metric)
+            else:
+                outgoing[addr] = [metric]
+        for addr, metrics in outgoing.iteritems():
+            self.forward(addr, metrics)
+
+    def forward(self, addr, metrics):
+        """
+        Send lines to a destination packed into as few datagrams as fit
+        relay_packet_size.
+
+        :param tuple addr: The destination
+        :param list metrics: The lines to send
+        """
+        packet = []
+        size = 0
+        for metric in metrics:
+            if packet and size + len(metric) > self.packet_size:
+                self._send(addr, '\n'.join(packet))
+                packet = []
+                size = 0
+            packet.append(metric)
+            size += len(metric) + 1
+        if packet:
+            self._send(addr, '\n'.join(packet))
+
+    def _send(self, addr, data):
+        try:
+            self.socks[addr].send(data)
+            self.forwarded[addr] += 1
+        except socket.error as err:
+            if err.args[0] != errno.ECONNREFUSED:
+                self.logger.critical("error relaying to %s:%d: %s" %
+                                     (addr + (err,)))
+                self.dropped += data.count('\n') + 1
+                return
+            # take it off the ring and send the lines to their new owners
+            self.mark_down(addr)
+            self.relay(data.split('\n'))
+
+    def health_check(self):
+        """
+        Periodically probe every destination with an empty datagram (which
+        statsdpy ignores), taking those that refuse it off the ring and
+        putting those that no longer do back on.
+        """
+        while True:
+            eventlet.sleep(self.check_interval)
+            was_down = set(self.down)
+            refused = set()
+            for addr, sock in self.socks.iteritems():
+                try:
+                    sock.send('')
+                except socket.error as err:
+                    if err.args[0] == errno.ECONNREFUSED:
+                        refused.add(addr)
+            # give any icmp port unreachable time to come back
+            eventlet.sleep(0.5)
+            for addr, sock in self.socks.iteritems():
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == errno.ECONNREFUSED:
+                    refused.add(addr)
+                if addr in refused:
+                    if addr not in self.down:
+                        self.mark_down(addr)
+                elif addr in was_down:
+                    self.mark_up(addr)
+            if self.debug:
+                print "relayed packets: %s, dropped lines: %d" % \
+                    (self.forwarded, self.dropped)
+
+    def final_snapshots(self):
+        """Nothing gets aggregated, so there's nothing to flush or
+        checkpoint on shutdown"""
+        return []
+
+    def reload(self):
+        """Relay mode doesn't reload its config, changes take a restart or
+        a hand over to a new process"""
+        self.logger.warning("relay mode doesn't reload its config, changes "
+                            "need a restart or a hand over (SIGUSR2)")
+
+    def run(self):
+        self.install_signal_handlers()
+        for receive, sock in self.extra_listeners():
+            eventlet.spawn_n(receive, sock)
+        for sock in self.udp_sockets():
+            eventlet.spawn_n(self.receive, sock)
+        self.close_inherited()
+        eventlet.spawn_n(self.health_check)
+        self.stopped.wait()
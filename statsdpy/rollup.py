@@ -0,0 +1,169 @@
+from statsdpy.hashring import ConsistentHashRing
+
+
+class FlushWindow(object):
+    """
+    How the stats of a flush interval get reported: every how many seconds,
+    under which prefix and to which graphite destinations.
+
+    The output of every key is compiled once and cached per window (see
+    StatsdServer.compile_names), as it depends on the prefix and on which
+    destination each metric name hashes to. So are the names of its metrics
+    as handed to the output backends.
+    """
+
+    def __init__(self, interval, destinations, prefix='', replica_count=100):
+        """
+        :param int interval: seconds between flushes
+        :param list destinations: (host, port, instance) of the carbons to
+                                  shard the output over
+        :param str prefix: prepended to every metric name, '' for none
+        :param int replica_count: ring positions per destination
+        """
+        self.interval = interval
+        self.destinations = destinations
+        self.prefix = prefix + '.' if prefix else ''
+        self.ring = None
+        if len(destinations) > 1:
+            # carbon-relay identifies destinations by (host, instance)
+            self.nodes = {}
+            for index, dest in enumerate(destinations):
+                node = (dest[0], dest[2])
+                if node in self.nodes:
+                    raise ValueError("graphite destinations on the same host "
+                                     "need distinct instances")
+                self.nodes[node] = index
+            # in the order they're listed, as carbon-relay adds them: where
+            # positions collide the node added first keeps its own
+            self.ring = ConsistentHashRing(
+                [(dest[0], dest[2]) for dest in destinations],
+                replica_count=replica_count)
+        self.counter_names = {}
+        self.timer_names = {}
+        self.gauge_names = {}
+        self.set_names = {}
+        self.self_stat_names = {}
+        # the names of the keys' metrics as handed to the output backends,
+        # per snapshot dict
+        self.metric_names = {'counters': {}, 'timers': {}, 'gauges': {},
+                             'sets': {}, 'internal': {}}
+        self.flush_stats = {}
+
+    def node(self, name):
+        """Return the index in destinations of the destination owning a
+        metric name"""
+        return self.nodes[self.ring.get_node(name)]
+
+
+class Rollup(FlushWindow):
+    """
+    A flush interval that's a multiple of flush_interval, aggregated from
+    the snapshots of flush_interval rather than from the events themselves.
+
+    Counters, sampled counts and timer samples are summed up over the
+    window, sets are merged, and gauges keep the last value they got.
+    """
+
+    def __init__(self, interval, flushes, new_timer, new_set, destinations,
+                 prefix='', replica_count=100):
+        """
+        :param int interval: seconds between flushes
+        :param int flushes: number of snapshots making up the window
+        :param new_timer: Returns an empty sample store for a timer
+        :param new_set: Returns an empty unique value counter for a set
+        :param list destinations: (host, port, instance) of the carbons to
+                                  shard the output over
+        :param str prefix: prepended to every metric name, '' for none
+        :param int replica_count: ring positions per destination
+        """
+        FlushWindow.__init__(self, interval, destinations, prefix,
+                             replica_count)
+        self.flushes = flushes
+        self.new_timer = new_timer
+        self.new_set = new_set
+        self.reset()
+
+    def reset(self):
+        """Start a new window"""
+        self.pending = 0
+        self.counters = {}
+        self.timers = {}
+        self.sampled_counts = {}
+        self.gauges = {}
+        self.sets = {}
+
+    def adopt(self, other):
+        """Carry on with the window of the rollup we replace on a reload
+
+        :param Rollup other: The rollup of the same interval to take over
+        """
+        self.pending = other.pending
+        self.counters = other.counters
+        self.timers = other.timers
+        self.sampled_counts = other.sampled_counts
+        self.gauges = other.gauges
+        self.sets = other.sets
+
+    def add(self, snapshot):
+        """
+        Merge in a snapshot of flush_interval
+
+        :param dict snapshot: The snapshot, from take_snapshot
+        :returns: True once the window is complete
+        """
+        counters = self.counters
+        for key, value in snapshot['counters'].iteritems():
+            counters[key] = counters.get(key, 0) + value
+        timers = self.timers
+        for key, timer in snapshot['timers'].iteritems():
+            if len(timer):
+                if key not in timers:
+                    timers[key] = self.new_timer()
+                timers[key].extend(timer)
+        sampled_counts = self.sampled_counts
+        for key, sampled in snapshot['sampled_counts'].iteritems():
+            sampled_counts[key] = sampled_counts.get(key, 0) + sampled
+        self.gauges.update(snapshot['gauges'])
+        sets = self.sets
+        for key, values in snapshot['sets'].iteritems():
+            if values is not None:
+                if sets.get(key) is None:
+                    sets[key] = self.new_set()
+                sets[key].update(values)
+            elif key not in sets:
+                sets[key] = None
+        self.pending += 1
+        return self.pending >= self.flushes
+
+    def take_snapshot(self, tstamp):
+        """
+        Return the state of the window to flush and start a new one.
+
+        Cached output of keys that aren't in the window anymore is dropped.
+
+        :param int tstamp: The timestamp for the data points
+        :returns: dict shaped like the snapshots of StatsdServer, with this
+                  window as 'window'
+        """
+        snapshot = {'tstamp': tstamp,
+                    'counters': self.counters,
+                    'timers': self.timers,
+                    'sampled_counts': self.sampled_counts,
+                    'gauges': self.gauges,
+                    'sets': self.sets,
+                    'internal': {},
+                    'window': self}
+        metric_names = self.metric_names
+        for names, reported in ((self.counter_names, self.counters),
+                                (self.timer_names, self.timers),
+                                (self.gauge_names, self.gauges),
+                                (self.set_names, self.sets),
+                                (metric_names['counters'], self.counters),
+                                (metric_names['timers'], self.timers),
+                                (metric_names['gauges'], self.gauges),
+                                (metric_names['sets'], self.sets)):
+            for key in names.keys():
+                if key not in reported:
+                    del names[key]
+        self.reset()
+        return snapshot
@@ -0,0 +1,80 @@
+import re
+
+#: a backreference, or a conditional, referring to a group of a pattern by
+#: number or name, which break once the pattern is part of a bigger regex
+GROUP_REFERENCE = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]|\(\?P=|\(\?\(')
+
+
+def parse_rule(spec):
+    """Parse a rule given as "deny <pattern>", "rewrite <pattern>
+    <replacement>" or "aggregate <pattern> <key>"
+
+    :returns: (kind, pattern, replacement) tuple, replacement is None for
+              deny rules
+    """
+    parts = spec.split()
+    if parts and parts[0] == 'deny' and len(parts) == 2:
+        return ('deny', parts[1], None)
+    if parts and parts[0] in ('rewrite', 'aggregate') and len(parts) == 3:
+        return tuple(parts)
+    raise ValueError("bad rule %r, expected deny <pattern>, rewrite "
+                     "<pattern> <replacement> or aggregate <pattern> <key>"
+                     % spec)
+
+
+class KeyRules(object):
+    """
+    Ordered rules deciding what a metric key gets aggregated as, the first
+    rule whose pattern is found in a key applies:
+
+    - deny drops the events of the key
+    - rewrite replaces the part of the key the pattern matched (backrefs
+      allowed), eg to collapse host names out of keys
+    - aggregate replaces the whole key, so all the keys matching end up
+      aggregated as one
+
+    All patterns are also compiled into a single regex, which tells in one
+    pass whether any rule applies to a key at all. For most keys none does.
+    Patterns referring back to their groups are renumbered in there, so
+    with any of those the rules are always tried one by one.
+    """
+
+    def __init__(self, rules):
+        """
+        :param list rules: (kind, pattern, replacement) tuples, in the order
+                           they're tried
+        """
+        self.rules = [(kind, re.compile(pattern), replacement)
+                      for kind, pattern, replacement in rules]
+        self.any_rule = None
+        if any(GROUP_REFERENCE.search(pattern)
+               for kind, pattern, replacement in rules):
+            # group numbers change once patterns are combined, the rules
+            # then just get tried one by one
+            return
+        try:
+            self.any_rule = re.compile('|'.join(
+                '(?:%s)' % pattern for kind, pattern, replacement in rules))
+        except (re.error, AssertionError):
+            # eg more groups than a single regex can have, the rules then
+            # just get tried one by one
+            self.any_rule = None
+
+    def __len__(self):
+        return len(self.rules)
+
+    def apply(self, key):
+        """Return what a key is aggregated as, None if it's denied
+
+        :param str key: The sanitized key
+        """
+        if self.any_rule is not None and not self.any_rule.search(key):
+            return key
+        for kind, regex, replacement in self.rules:
+            if regex.search(key):
+                if kind == 'deny':
+                    return None
+                if kind == 'rewrite':
+                    return regex.sub(replacement, key, 1)
+                return replacement
+        return key
@@ -0,0 +1,146 @@
+import math
+
+# anything closer to zero than this is counted as zero
+MIN_INDEXABLE = 1e-9
+
+
+class LogSketch(object):
+    """
+    Bounded memory store for timer samples.
+
+    Samples are counted in logarithmically sized buckets (as in DDSketch), so
+    memory use depends on the range of the samples rather than their number
+    and a quantile lookup walks at most max_bins buckets however many samples
+    were added.
+
+    Error bound: a value returned by value_at() is within relative_accuracy of
+    the exact sample at that rank, i.e. for relative_accuracy=0.01 an exact
+    upper_90 of 250ms is reported as something between 247.5ms and 252.5ms.
+    The bound holds as long as the samples span fewer than max_bins buckets
+    (2048 buckets at 1% covers about 18 orders of magnitude); beyond that the
+    buckets closest to zero are collapsed and only the lowest quantiles lose
+    accuracy. count, low, high and total are always exact.
+
+    The sketch offers the append/extend/len subset of the list interface so it
+    can be used in place of a list of samples.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.negative_bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        """Add a sample
+
+        :param float value: The sample to add
+        """
+        if value > MIN_INDEXABLE:
+            idx = int(math.ceil(math.log(value) / self.log_gamma))
+            self.bins[idx] = self.bins.get(idx, 0) + 1
+            if len(self.bins) > self.max_bins:
+                self._collapse(self.bins)
+        elif value < -MIN_INDEXABLE:
+            idx = int(math.ceil(math.log(-value) / self.log_gamma))
+            self.negative_bins[idx] = self.negative_bins.get(idx, 0) + 1
+            if len(self.negative_bins) > self.max_bins:
+                self._collapse(self.negative_bins)
+        else:
+            self.zeros += 1
+        if self.count == 0:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+
+    def extend(self, other):
+        """Merge the samples of another sketch into this one
+
+        :param LogSketch other: A sketch with the same relative_accuracy
+        """
+        if not other.count:
+            return
+        for bins, other_bins in ((self.bins, other.bins),
+                                 (self.negative_bins, other.negative_bins)):
+            for idx, count in other_bins.iteritems():
+                bins[idx] = bins.get(idx, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zeros += other.zeros
+        if self.count == 0 or other.min < self.min:
+            self.min = other.min
+        if self.count == 0 or other.max > self.max:
+            self.max = other.max
+        self.count += other.count
+        self.total += other.total
+        self.total_squares += other.total_squares
+
+    def _collapse(self, bins):
+        """Fold the buckets closest to zero together to honour max_bins"""
+        indexes = sorted(bins)
+        excess = len(indexes) - self.max_bins + 1
+        folded = sum(bins.pop(idx) for idx in indexes[:excess])
+        target = indexes[excess]
+        bins[target] += folded
+
+    def _value(self, idx):
+        """The representative value of a bucket"""
+        return 2 * self.gamma ** idx / (self.gamma + 1)
+
+    def _buckets(self):
+        """Yield (value, count) for every bucket in ascending value order"""
+        for idx in sorted(self.negative_bins, reverse=True):
+            yield max(-self._value(idx), self.min), self.negative_bins[idx]
+        if self.zeros:
+            yield 0.0, self.zeros
+        for idx in sorted(self.bins):
+            yield min(self._value(idx), self.max), self.bins[idx]
+
+    def value_at(self, rank):
+        """Estimate the sample at rank in the sorted samples
+
+        :param int rank: 0 based rank, negative ranks count from the end
+                         like list indexes do
+        :returns: the estimated sample, clamped to the exact min and max
+        """
+        if rank < 0:
+            rank += self.count
+        return self.ranked_sums([rank + 1])[0][0]
+
+    def ranked_sums(self, counts):
+        """Estimate the nth smallest sample and the sum of the n smallest
+        samples for several n in a single walk over the buckets
+
+        :param list counts: ascending list of n, each 1 <= n <= len(self)
+        :returns: list of (nth smallest sample, sum) tuples, one per n
+        """
+        results = []
+        wanted = iter(counts)
+        n = next(wanted, None)
+        seen = 0
+        running = 0.0
+        for value, count in self._buckets():
+            while n is not None and seen + count >= n:
+                results.append((value, running + (n - seen) * value))
+                n = next(wanted, None)
+            if n is None:
+                break
+            seen += count
+            running += count * value
+        return results
@@ -0,0 +1,170 @@
+import struct
+import time
+import os
+
+#: record header, (payload length, time the payload was spooled)
+HEADER = struct.Struct("!LL")
+
+
+class Spool(object):
+    """
+    Bounded on disk FIFO queue for payloads graphite didn't accept.
+
+    Payloads are appended to numbered segment files as length prefixed
+    records. Once the spool grows past max_bytes whole segments are dropped
+    oldest first, and records older than max_age are skipped when read. The
+    read position is kept in a cursor file so a restart resumes where the
+    replay left off.
+    """
+
+    def __init__(self, path, max_bytes=104857600, max_age=86400,
+                 segment_bytes=8388608):
+        """
+        :param str path: directory to keep the segment files in
+        :param int max_bytes: max total size of the spool
+        :param int max_age: seconds after which spooled payloads are dropped,
+                            0 to keep them until max_bytes is hit
+        :param int segment_bytes: size at which to start a new segment
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(path)
+                               if name.endswith('.seg'))
+        self.read_offset = 0
+        self.peeked = None
+        # always append to a fresh segment, never after a record that may
+        # have been cut short when we last went down
+        self.writing = False
+        #: number of payloads dropped due to max_bytes or max_age
+        self.dropped = 0
+        self._load_cursor()
+        #: number of payloads waiting to be replayed
+        self.depth = 0
+        #: bytes used by the payloads waiting to be replayed
+        self.bytes = 0
+        for i, seq in enumerate(self.segments):
+            records, size = self._scan(seq, self.read_offset if not i else 0)
+            self.depth += records
+            self.bytes += size
+
+    def _segment(self, seq):
+        return os.path.join(self.path, '%016d.seg' % seq)
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.path, 'cursor')) as f:
+                seq, offset = [int(i) for i in f.read().split()]
+        except (IOError, ValueError):
+            return
+        # segments before the cursor were fully replayed
+        while self.segments and self.segments[0] < seq:
+            os.unlink(self._segment(self.segments.pop(0)))
+        if self.segments and self.segments[0] == seq:
+            self.read_offset = offset
+
+    def _save_cursor(self):
+        seq = self.segments[0] if self.segments else 0
+        tmp = os.path.join(self.path, 'cursor.tmp')
+        with open(tmp, 'w') as f:
+            f.write('%d %d\n' % (seq, self.read_offset))
+        os.rename(tmp, os.path.join(self.path, 'cursor'))
+
+    def _scan(self, seq, offset):
+        """Count the complete records in a segment from offset onwards
+
+        :returns: tuple of (records, bytes)
+        """
+        records = 0
+        size = 0
+        end = os.path.getsize(self._segment(seq))
+        with open(self._segment(seq), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                length = HEADER.unpack(header)[0]
+                if f.tell() + length > end:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                records += 1
+                size += HEADER.size + length
+        return records, size
+
+    def _drop_head(self):
+        """Remove the oldest segment along with any unread records in it"""
+        records, size = self._scan(self.segments[0], self.read_offset)
+        os.unlink(self._segment(self.segments.pop(0)))
+        self.read_offset = 0
+        self.peeked = None
+        self.depth -= records
+        self.bytes -= size
+        self._save_cursor()
+        return records
+
+    def append(self, data):
+        """Add a payload to the end of the spool
+
+        :param str data: The payload
+        """
+        size = HEADER.size + len(data)
+        if not self.writing or not self.segments or \
+                os.path.getsize(self._segment(self.segments[-1])) >= \
+                self.segment_bytes or \
+                (len(self.segments) == 1 and
+                 self.bytes + size > self.max_bytes):
+            # past max_bytes the segment we write to has to be a new one,
+            # or the older payloads couldn't be dropped without it
+            self.segments.append(self.segments[-1] + 1 if self.segments
+                                 else 1)
+            self.writing = True
+        with open(self._segment(self.segments[-1]), 'ab') as f:
+            f.write(HEADER.pack(len(data), int(time.time())) + data)
+        self.depth += 1
+        self.bytes += size
+        # a payload bigger than max_bytes by itself goes as well
+        while self.bytes > self.max_bytes and self.segments:
+            self.dropped += self._drop_head()
+
+    def peek(self):
+        """Return the oldest payload still within max_age without removing
+        it, or None if the spool is empty
+        """
+        while self.segments:
+            with open(self._segment(self.segments[0]), 'rb') as f:
+                f.seek(self.read_offset)
+                header = f.read(HEADER.size)
+                if len(header) == HEADER.size:
+                    length, stamp = HEADER.unpack(header)
+                    data = f.read(length)
+                else:
+                    length, data = 0, ''
+            if len(header) < HEADER.size or len(data) < length:
+                # end of the segment (or a record cut short by a crash)
+                if len(self.segments) == 1:
+                    if self.read_offset:
+                        self._drop_head()
+                    return None
+                self._drop_head()
+                continue
+            self.peeked = length
+            if self.max_age and time.time() - stamp > self.max_age:
+                self.pop()
+                self.dropped += 1
+                continue
+            return data
+        return None
+
+    def pop(self):
+        """Remove the payload last returned by peek"""
+        if self.peeked is None:
+            return
+        self.read_offset += HEADER.size + self.peeked
+        self.depth -= 1
+        self.bytes -= HEADER.size + self.peeked
+        self.peeked = None
+        self._save_cursor()
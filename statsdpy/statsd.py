@@ -1,20 +1,61 @@
 import eventlet
+import eventlet.event
+import eventlet.queue
 from eventlet.green import socket
+from eventlet.hubs import trampoline
 from statsdpy.daemonutils import Daemon, readconf
+from statsdpy.sketch import LogSketch
+from statsdpy.hll import UniqueSet
+from statsdpy.carbon import CarbonClient
+from statsdpy.spool import Spool
+from statsdpy.keycache import KeyCache
+from statsdpy.rules import KeyRules, parse_rule
+from statsdpy.rollup import FlushWindow, Rollup
+from statsdpy.backends import make_backend
 from logging.handlers import SysLogHandler
 import logging
 from sys import maxint
+from itertools import islice, chain
+from functools import partial
+from array import array
+from stat import S_ISSOCK
 import optparse
+import signal
+import fcntl
 import cPickle as pickle
 import struct
+import errno
+import math
 import time
 import sys
 import os
 import re
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# environment variable listing the listen sockets handed over to a new
+# process, as comma separated name:fd
+HANDOVER_ENV = 'STATSDPY_LISTEN_FDS'
 
 
 class StatsdServer(object):
     TRUE_VALUES = set(('true', '1', 'yes', 'on', 't', 'y'))
+    # the options configure applies, besides rollup_<interval>_*
+    LIVE_OPTIONS = set((
+        '__file__', 'log_name', 'debug', 'flush_interval',
+        'flush_yield_every', 'percent_threshold', 'key_ttl', 'counter_ttl',
+        'timer_ttl', 'gauge_ttl', 'set_ttl', 'graphite_host',
+        'graphite_port', 'graphite_pickle_port', 'graphite_timeout',
+        'graphite_pool_size', 'graphite_persistent', 'pickle_protocol',
+        'pickle_batch_size', 'graphite_destinations',
+        'graphite_ring_replicas', 'spool_dir', 'spool_max_bytes',
+        'spool_max_age', 'spool_segment_bytes', 'spool_replay_rate',
+        'spool_retry_interval', 'rollups', 'self_stats',
+        'self_stats_prefix', 'state_file', 'state_max_age',
+        'shutdown_timeout', 'legacy_namespace', 'global_prefix',
+        'prefix_counter', 'prefix_timer', 'prefix_gauge', 'prefix_set'))
 
     def __init__(self, conf):
         self.logger = logging.getLogger('statsdpy')
@@ -24,34 +65,231 @@ class StatsdServer(object):
         self.formatter = logging.Formatter('%(name)s: %(message)s')
         self.syslog.setFormatter(self.formatter)
         self.logger.addHandler(self.syslog)
-        self.conf = conf
-        self.graphite_host = conf.get('graphite_host', '127.0.0.1')
-        self.graphite_port = int(conf.get('graphite_port', '2003'))
-        self.graphite_pport = int(conf.get('graphite_pickle_port', '2004'))
-        self.graphite_timeout = int(conf.get('graphite_timeout', '5'))
-        self.pickle_proto = conf.get('pickle_protocol') in self.TRUE_VALUES
-        self.max_batch_size = int(conf.get('pickle_batch_size', '300'))
         self.listen_addr = conf.get('listen_addr', '127.0.0.1')
         self.listen_port = int(conf.get('listen_port', 8125))
-        self.debug = conf.get('debug') in self.TRUE_VALUES
-        self.flush_interval = int(conf.get('flush_interval', 10))
-        self.pct_threshold = int(conf.get('percent_threshold', 90))
-        self.threshold_numerator = float(self.pct_threshold / 100.0)
-        if self.pickle_proto:
-            self.graphite_addr = (self.graphite_host, self.graphite_pport)
-        else:
-            self.graphite_addr = (self.graphite_host, self.graphite_port)
+        self.recv_batch_size = int(conf.get('recv_batch_size', 64))
+        self.recv_buffer_size = int(conf.get('recv_buffer_size', 0))
+        self.max_datagram_size = int(conf.get('max_datagram_size', 8192))
+        self.tcp_listen_port = int(conf.get('tcp_listen_port', 0))
+        self.unix_dgram_socket = conf.get('unix_dgram_socket')
+        self.unix_stream_socket = conf.get('unix_stream_socket')
+        self.stream_max_line = int(conf.get('stream_max_line', 65536))
+        self.workers = int(conf.get('workers', 1))
+        self.timer_sketch = conf.get('timer_backend', 'exact') == 'sketch'
+        self.sketch_accuracy = float(conf.get('sketch_relative_accuracy',
+                                              '0.01'))
+        self.sketch_max_bins = int(conf.get('sketch_max_bins', '2048'))
+        self.set_max_exact = int(conf.get('set_max_exact', '1000'))
+        self.set_precision = int(conf.get('set_hll_precision', '14'))
         self.keycheck = re.compile(r'\s+|/|[^a-zA-Z_\-0-9\.]')
         self.ratecheck = re.compile('^@([\d\.]+)')
+        # deny/rewrite/aggregate rules, in the order they're listed
+        rules = []
+        for name in conf.get('rules', '').split(','):
+            name = name.strip()
+            if not name:
+                continue
+            spec = conf.get('rule_%s' % name)
+            if not spec:
+                raise ValueError("rule %s isn't defined" % name)
+            rules.append(parse_rule(spec))
+        try:
+            self.rules = KeyRules(rules) if rules else None
+        except re.error as err:
+            raise ValueError("bad pattern in rules: %s" % err)
+        resolve = self.resolve_key if self.rules else self.sanitize_key
+        key_cache_size = int(conf.get('key_cache_size', '10000'))
+        if key_cache_size:
+            self.key_cache = KeyCache(resolve, key_cache_size)
+            self.clean_key = self.key_cache.get
+        else:
+            self.key_cache = None
+            self.clean_key = resolve
         self.counters = {}
         self.timers = {}
+        self.spare_timers = {}
+        # events represented by sampled timer samples on top of the samples
+        # themselves (1 / rate - 1 for each)
+        self.sampled_counts = {}
         self.gauges = {}
+        # +/- gauge events for keys without a value since the last flush,
+        # applied to the gauge's last value when flushing
+        self.gauge_deltas = {}
+        # the last flushed value of the tracked gauges
+        self.gauge_last = {}
+        self.sets = {}
+        # every key still being reported, mapped to the number of flushes
+        # it went without an update, the dicts above only hold the values
+        # received since the last flush
+        self.counter_keys = {}
+        self.timer_keys = {}
+        self.gauge_keys = {}
+        self.set_keys = {}
+        self.max_counters = int(conf.get('max_counters', 0))
+        self.max_timers = int(conf.get('max_timers', 0))
+        self.max_gauges = int(conf.get('max_gauges', 0))
+        self.max_sets = int(conf.get('max_sets', 0))
+        self.overflow = {}
+        self.expired = {}
+        # only tracked by worker processes, so the coordinator can tell
+        # which worker saw the most recent value of a gauge, and which
+        # deltas (kept as [stamp, delta] per key) came after it
+        self.gauge_stamps = None
+        self.gauge_events = None
         self.stats_seen = 0
+        self.recv_wakeups = 0
+        self.recv_errors = 0
+        self.recv_datagrams = 0
+        self.stream_connections = 0
+        self.lines_received = 0
+        self.bad_lines = {}
+        self.denied = 0
+        self.last_stats_seen = 0
+        self.worker_ingest = {}
+        self.worker_socks = []
+        # worker control socket to the worker's pid and udp sockets
+        self.worker_procs = {}
+        # seconds a worker gets to hand over its state at flush time
+        self.worker_timeout = int(conf.get('worker_timeout', 10))
+        self.flush_queue = eventlet.queue.Queue()
+        # outputs besides graphite, fed from the same snapshots
+        self.backends = []
+        for name in conf.get('backends', '').split(','):
+            name = name.strip()
+            if not name:
+                continue
+            option = 'backend_%s_' % name
+            options = dict((key[len(option):], value) for key, value in
+                           conf.iteritems() if key.startswith(option))
+            self.backends.append(make_backend(name, options, self.logger))
+        self.stopping = False
+        # sent once the last flushes went out, or once a worker handed the
+        # coordinator its last state
+        self.stopped = eventlet.event.Event()
+        # (name, socket) of every listen socket, to hand over to a new
+        # process, and the sockets a previous process handed over to us
+        self.listen_socks = []
+        self.inherited = {}
+        for item in os.environ.pop(HANDOVER_ENV, '').split(','):
+            if item:
+                name, fd = item.split(':')
+                self.inherited.setdefault(name, []).append(int(fd))
+        # command line starting a new process to hand over to, set by
+        # run_server
+        self.argv = None
         self.processors = {
             'g': self.process_gauge,
             'c': self.process_counter,
             'ms': self.process_timer,
+            's': self.process_set,
         }
+        self.carbons = {}
+        self.spools = {}
+        # destinations whose spool is being replayed
+        self.replaying = set()
+        self.rollups = []
+        self.configure(conf)
+
+    def configure(self, conf):
+        """
+        Apply the settings that may change while running, on startup and
+        then on every reload: what gets reported, where to, under which
+        names and how often.
+
+        Destinations are only ever added, those the config no longer lists
+        keep their spool (and its replayer) but are no longer sent to. The
+        connections and spool of those still listed are set up anew when
+        their settings changed.
+
+        :param dict conf: The configuration data
+        """
+        self.conf = conf
+        self.debug = conf.get('debug') in self.TRUE_VALUES
+        self.flush_interval = int(conf.get('flush_interval', 10))
+        self.flush_yield_every = int(conf.get('flush_yield_every', 1000))
+        self.pct_thresholds = []
+        for pct in conf.get('percent_threshold', '90').split(','):
+            pct = float(pct)
+            self.pct_thresholds.append((pct / 100.0,
+                                        ('%g' % pct).replace('.', '_')))
+        # the order timer_values returns a timer's stats in
+        self.timer_metrics = ['count', 'low', 'high', 'total', 'mean', 'std',
+                              'median']
+        for pct, suffix in self.pct_thresholds:
+            self.timer_metrics.extend(stat + suffix for stat in
+                                      ('upper_', 'count_', 'sum_', 'mean_'))
+        key_ttl = int(conf.get('key_ttl', 0))
+        self.counter_ttl = int(conf.get('counter_ttl', key_ttl))
+        self.timer_ttl = int(conf.get('timer_ttl', key_ttl))
+        self.gauge_ttl = int(conf.get('gauge_ttl', key_ttl))
+        self.set_ttl = int(conf.get('set_ttl', key_ttl))
+        self.graphite_host = conf.get('graphite_host', '127.0.0.1')
+        self.graphite_port = int(conf.get('graphite_port', '2003'))
+        self.graphite_pport = int(conf.get('graphite_pickle_port', '2004'))
+        self.graphite_timeout = int(conf.get('graphite_timeout', '5'))
+        self.pickle_proto = conf.get('pickle_protocol') in self.TRUE_VALUES
+        self.max_batch_size = int(conf.get('pickle_batch_size', '300'))
+        if self.pickle_proto:
+            self.graphite_addr = (self.graphite_host, self.graphite_pport)
+        else:
+            self.graphite_addr = (self.graphite_host, self.graphite_port)
+        # (host, port, instance) of every carbon we shard the output over
+        self.carbon_destinations = parse_destinations(
+            conf.get('graphite_destinations', ''))
+        if not self.carbon_destinations:
+            self.carbon_destinations = [self.graphite_addr + (None,)]
+        # copies, so that a reload failing halfway leaves the running
+        # ones alone
+        self.carbons = dict(self.carbons)
+        self.spools = dict(self.spools)
+        configured = set()
+        for dest in self.carbon_destinations:
+            configured.add(dest)
+            self.add_carbon(dest, own_spool=len(
+                self.carbon_destinations) > 1)
+        replicas = int(conf.get('graphite_ring_replicas', '100'))
+        self.window = FlushWindow(self.flush_interval,
+                                  self.carbon_destinations,
+                                  replica_count=replicas)
+        self.flush_stats = self.window.flush_stats
+        # coarser flush intervals, fed with the snapshots of flush_interval
+        previous = dict((rollup.interval, rollup) for rollup in self.rollups)
+        self.rollups = []
+        for interval in conf.get('rollups', '').split(','):
+            if not interval.strip():
+                continue
+            interval = int(interval)
+            if interval <= self.flush_interval or \
+                    interval % self.flush_interval:
+                raise ValueError("rollup interval %d isn't a multiple of "
+                                 "flush_interval" % interval)
+            option = 'rollup_%d_' % interval
+            destinations = parse_destinations(
+                conf.get(option + 'destinations', '')) or \
+                self.carbon_destinations
+            prefix = conf.get(option + 'prefix', 'rollup%d' % interval)
+            if not prefix and destinations == self.carbon_destinations:
+                raise ValueError("rollup %d needs its own prefix or "
+                                 "destinations" % interval)
+            for dest in destinations:
+                if dest not in configured:
+                    configured.add(dest)
+                    self.add_carbon(dest, own_spool=True)
+            rollup = Rollup(
+                interval, interval // self.flush_interval, self.new_timer,
+                self.new_set, destinations, prefix=prefix,
+                replica_count=replicas)
+            if interval in previous:
+                rollup.adopt(previous[interval])
+            self.rollups.append(rollup)
+        self.spool_replay_rate = float(conf.get('spool_replay_rate', '50'))
+        self.spool_retry_interval = int(conf.get('spool_retry_interval',
+                                                 '10'))
+        self.self_stats = conf.get('self_stats', 'yes') in self.TRUE_VALUES
+        self.self_stats_prefix = conf.get('self_stats_prefix', 'statsdpy')
+        self.state_file = conf.get('state_file')
+        self.state_max_age = int(conf.get('state_max_age', 300))
+        self.shutdown_timeout = int(conf.get('shutdown_timeout', 10))
         self._set_prefixes(conf)
 
     def _set_prefixes(self, conf):
@@ -65,6 +303,7 @@ class StatsdServer(object):
             self.count_suffix = ''
             self.gauge_prefix = 'stats.gauges'
             self.timer_prefix = 'stats.timers'
+            self.set_prefix = 'stats.sets'
             self.rate_prefix = 'stats'
             self.rate_suffix = ''
         else:
@@ -77,143 +316,1154 @@ class StatsdServer(object):
                                            conf.get('prefix_gauge', 'gauges'))
             self.timer_prefix = '%s.%s' % (global_prefix,
                                            conf.get('prefix_timer', 'timers'))
+            self.set_prefix = '%s.%s' % (global_prefix,
+                                         conf.get('prefix_set', 'sets'))
             self.rate_prefix = self.count_prefix
             self.rate_suffix = '.rate'
 
+    def add_carbon(self, dest, own_spool=False):
+        """Set up the connections, and spool if spooling is on, of a graphite
+        destination, or set them up anew if their settings changed since
+
+        :param tuple dest: The (host, port, instance) to send to
+        :param bool own_spool: spool under spool_dir/<host>_<port> rather
+                               than in spool_dir itself
+        """
+        conf = self.conf
+        settings = (self.graphite_timeout,
+                    int(conf.get('graphite_pool_size', '1')),
+                    conf.get('graphite_persistent', 'yes') in
+                    self.TRUE_VALUES)
+        carbon = self.carbons.get(dest)
+        if not carbon or \
+                (carbon.timeout, carbon.pool_size, carbon.persistent) != \
+                settings:
+            timeout, pool_size, persistent = settings
+            self.carbons[dest] = CarbonClient(
+                dest[:2], timeout=timeout, pool_size=pool_size,
+                persistent=persistent)
+        if not conf.get('spool_dir'):
+            # what's spooled stays on disk for when spooling is back on
+            self.spools.pop(dest, None)
+            return
+        path = conf['spool_dir']
+        if own_spool:
+            path = os.path.join(path, '%s_%d' % dest[:2])
+        settings = (path, int(conf.get('spool_max_bytes', '104857600')),
+                    int(conf.get('spool_max_age', '86400')),
+                    int(conf.get('spool_segment_bytes', '8388608')))
+        spool = self.spools.get(dest)
+        if not spool or (spool.path, spool.max_bytes, spool.max_age,
+                         spool.segment_bytes) != settings:
+            path, max_bytes, max_age, segment_bytes = settings
+            self.spools[dest] = Spool(path, max_bytes=max_bytes,
+                                      max_age=max_age,
+                                      segment_bytes=segment_bytes)
+
+    def new_timer(self):
+        """Return an empty sample store for a timer key"""
+        if self.timer_sketch:
+            return LogSketch(self.sketch_accuracy, self.sketch_max_bins)
+        # 8 bytes per sample instead of a boxed float in a list
+        return array('d')
+
+    def new_set(self):
+        """Return an empty unique value counter for a set key"""
+        return UniqueSet(self.set_max_exact, self.set_precision)
+
+    def recycle_timers(self, timers):
+        """Empty flushed timers so their storage can be swapped back in,
+        dropping those of keys that expired
+
+        :param dict timers: The timers of a flushed snapshot
+        """
+        keys = self.timer_keys
+        for key in timers.keys():
+            if key not in keys:
+                del timers[key]
+            elif self.timer_sketch:
+                timers[key] = self.new_timer()
+            else:
+                del timers[key][:]
+        self.spare_timers = timers
+
+    def _cooperative(self, iterable):
+        """Iterate, letting the hub run every flush_yield_every items"""
+        every = self.flush_yield_every
+        for i, item in enumerate(iterable):
+            if i and not i % every:
+                eventlet.sleep(0)
+            yield item
+
+    def sanitize_key(self, raw):
+        """Replace the characters graphite can't handle in a received key"""
+        return self.keycheck.sub('_', raw)
+
+    def resolve_key(self, raw):
+        """Sanitize a received key and pass it through the rules
+
+        :returns: the key to aggregate the event under, None to drop it
+        """
+        sanitized = self.sanitize_key(raw)
+        key = self.rules.apply(sanitized)
+        if key is sanitized:
+            return key
+        if not key:
+            return None
+        return self.sanitize_key(key)
+
     def _get_batches(self, items):
         """given a list yield list at most self.max_batch_size in size"""
         for i in xrange(0, len(items), self.max_batch_size):
             yield items[i:i + self.max_batch_size]
 
-    def report_stats(self, payload, is_retry=False):
+    def compile_names(self, names, window, line='%s %%s %%s\n'):
+        """
+        Precompute the output of a key from the graphite names of its
+        metrics.
+
+        For the plaintext protocol the lines of the key become a single
+        format string, taking the values interleaved with the timestamp. For
+        the pickle protocol the names are kept as they are. When sharding
+        over several destinations, the metrics are grouped by destination
+        first.
+
+        :param list names: The names, in the order of the key's values
+        :param FlushWindow window: The window the output is for
+        :param str line: format of a plaintext line, given the name
+        :returns: the format string or names, or when sharding a tuple of
+                  (destination index, format string or names, positions of
+                  the values that go there)
+        """
+        if window.prefix:
+            names = [window.prefix + name for name in names]
+        if not window.ring:
+            return self._compile_group(names, line)
+        groups = {}
+        for position, name in enumerate(names):
+            groups.setdefault(window.node(name), []).append(position)
+        return tuple((index,
+                      self._compile_group([names[i] for i in positions], line),
+                      tuple(positions))
+                     for index, positions in sorted(groups.iteritems()))
+
+    def _compile_group(self, names, line):
+        if self.pickle_proto:
+            return tuple(names)
+        return "".join(line % name.replace('%', '%%') for name in names)
+
+    def cache_names(self, cache, key, build):
+        """Build and cache the output of a key
+
+        :param dict cache: The name cache of the key's type
+        :param str key: The key
+        :param build: Returns the output for a key
+        """
+        names = cache[key] = build(key)
+        return names
+
+    def counter_metric_names(self, key):
+        """The graphite names of a counter's rate and count"""
+        return ["%s.%s%s" % (self.rate_prefix, key, self.rate_suffix),
+                "%s.%s%s" % (self.count_prefix, key, self.count_suffix)]
+
+    def timer_metric_names(self, key):
+        """The graphite names of a timer's stats, in timer_values order"""
+        return ["%s.%s.%s" % (self.timer_prefix, key, metric)
+                for metric in self.timer_metrics]
+
+    def gauge_metric_names(self, key):
+        """The graphite name of a gauge"""
+        return ["%s.%s" % (self.gauge_prefix, key)]
+
+    def set_metric_names(self, key):
+        """The graphite name of a set's count"""
+        return ["%s.%s.count" % (self.set_prefix, key)]
+
+    def self_stat_metric_names(self, name):
+        """The graphite name of one of our own metrics"""
+        return ["%s.%s" % (self.self_stats_prefix, name)]
+
+    def counter_output(self, window, key):
+        """The compiled output of a counter's rate and count"""
+        return self.compile_names(self.counter_metric_names(key), window)
+
+    def timer_output(self, window, key):
+        """The compiled output of a timer's stats, in timer_values order"""
+        return self.compile_names(self.timer_metric_names(key), window)
+
+    def gauge_output(self, window, key):
+        """The compiled output of a gauge"""
+        return self.compile_names(self.gauge_metric_names(key), window,
+                                  line='%s %%d %%s\n')
+
+    def set_output(self, window, key):
+        """The compiled output of a set"""
+        return self.compile_names(self.set_metric_names(key), window)
+
+    def self_stat_output(self, window, name):
+        """The compiled output of one of our own metrics"""
+        return self.compile_names(self.self_stat_metric_names(name), window)
+
+    def metric_names(self, window, metrics, key):
         """
-        Send data to graphite host
+        The names of a key's metrics as handed to the output backends,
+        shared by all of them
 
-        :param payload: Data to send to graphite
+        :param FlushWindow window: The window the output is for
+        :param metrics: Returns the graphite names of a key's metrics
+        :param str key: The key
         """
+        return tuple(window.prefix + name for name in metrics(key))
+
+    def shard_lines(self, shards, groups, args):
+        """Add the plaintext lines of a sharded key to their destinations
+
+        :param list shards: The lines of each destination
+        :param tuple groups: The key's compiled output
+        :param tuple args: The key's values interleaved with the timestamp
+        """
+        for index, template, positions in groups:
+            shards[index].append(template % tuple(chain.from_iterable(
+                args[2 * i:2 * i + 2] for i in positions)))
+
+    def shard_items(self, shards, groups, tstamp, values):
+        """Add the pickle items of a sharded key to their destinations
+
+        :param list shards: The items of each destination
+        :param tuple groups: The key's compiled output
+        :param int tstamp: The timestamp for the data points
+        :param list values: The key's values
+        """
+        for index, names, positions in groups:
+            shards[index].extend((name, (tstamp, values[i]))
+                                 for name, i in zip(names, positions))
+
+    def report_stats(self, payloads):
+        """
+        Send data to the graphite destinations, all of them in parallel
+
+        :param dict payloads: Destination to the list of strings (eg pickle
+                              batches) to send it back to back
+        """
+        if len(payloads) == 1:
+            for dest, payload in payloads.iteritems():
+                self.send_payload(dest, payload)
+            return
+        pool = eventlet.GreenPool(len(payloads))
+        for dest, payload in payloads.iteritems():
+            pool.spawn_n(self.send_payload, dest, payload)
+        pool.waitall()
+
+    def send_payload(self, dest, payload):
+        """
+        Send data to a graphite destination, spooling it if that fails
+
+        :param tuple dest: The (host, port, instance) to send to
+        :param list payload: The strings to send back to back
+        """
+        carbon = self.carbons[dest]
         if self.debug:
             if self.pickle_proto:
-                print "reporting pickled stats"
+                print "reporting pickled stats to %s:%d" % dest[:2]
             else:
-                print "reporting stats -> {\n%s}" % payload
+                print "reporting stats to %s:%d -> {\n%s}" % \
+                    (dest[:2] + ("".join(payload),))
         try:
-            graphite = socket.socket()
-            with eventlet.Timeout(self.graphite_timeout, True):
-                graphite.connect(self.graphite_addr)
-                graphite.sendall(payload)
-                graphite.close()
+            carbon.send(payload)
+            return
         except eventlet.timeout.Timeout:
-            self.logger.critical("Timeout sending to graphite")
+            self.logger.critical("Timeout sending to graphite %s:%d, giving "
+                                 "up" % dest[:2])
             if self.debug:
-                print "Timeout talking to graphite"
-            if not is_retry:
-                self.logger.critical('Attempting 1 retry!')
-                self.report_stats(payload, is_retry=True)
-            else:
-                self.logger.critical('Already retried once, giving up')
+                print "Timeout talking to graphite %s:%d" % dest[:2]
         except Exception as err:
-            self.logger.critical("error connecting to graphite: %s" % err)
+            self.logger.critical("error connecting to graphite %s:%d: %s" %
+                                 (dest[:2] + (err,)))
             if self.debug:
-                print "error connecting to graphite: %s" % err
+                print "error connecting to graphite %s:%d: %s" % \
+                    (dest[:2] + (err,))
         finally:
+            if self.debug:
+                stats = carbon.stats
+                print "graphite connects: %d reconnects: %d send time: " \
+                    "%.3fs" % (stats['connects'], stats['reconnects'],
+                               stats['send_time'])
+        self.spool_payload(dest, payload)
+
+    def spool_payload(self, dest, payload):
+        """
+        Spool data a graphite destination didn't take, if spooling is on
+
+        :param tuple dest: The (host, port, instance) it was meant for
+        :param list payload: The strings that were sent back to back
+        """
+        spool = self.spools.get(dest)
+        if spool:
+            # carbon overwrites datapoints it already has, so batches that
+            # did make it before the failure are simply spooled again
+            for batch in payload:
+                spool.append(batch)
+            self.logger.critical("spooled payload, %d payloads (%d bytes) "
+                                 "waiting for graphite %s:%d" %
+                                 ((spool.depth, spool.bytes) + dest[:2]))
+
+    def start_replayer(self, dest):
+        """Start replaying the spool of a destination in the background,
+        unless it already is
+
+        :param tuple dest: The (host, port, instance) to replay to
+        """
+        if dest not in self.replaying:
+            self.replaying.add(dest)
+            eventlet.spawn_n(self.spool_replayer, dest)
+
+    def spool_replayer(self, dest):
+        """
+        Periodically replay the payloads spooled for a destination, oldest
+        first and at most spool_replay_rate per second, for as long as it
+        takes them. The connections and spool are looked up every time
+        round, as a reload may set them up anew, and the replayer stops
+        once the destination isn't spooled to anymore.
+
+        :param tuple dest: The (host, port, instance) to replay to
+        """
+        while True:
+            eventlet.sleep(self.spool_retry_interval)
+            spool = self.spools.get(dest)
+            if not spool:
+                self.replaying.discard(dest)
+                return
+            carbon = self.carbons[dest]
             try:
-                graphite.close()
-            except Exception:
-                pass
+                data = spool.peek()
+                while data is not None and self.spools.get(dest) is spool:
+                    carbon.send([data])
+                    spool.pop()
+                    eventlet.sleep(1.0 / self.spool_replay_rate)
+                    data = spool.peek()
+            except eventlet.timeout.Timeout:
+                self.logger.critical("Timeout replaying spool to %s:%d, %d "
+                                     "payloads left" %
+                                     (dest[:2] + (spool.depth,)))
+            except Exception as err:
+                self.logger.critical("error replaying spool to %s:%d: %s, %d "
+                                     "payloads left" %
+                                     (dest[:2] + (err, spool.depth)))
+
+    def take_ingest_stats(self):
+        """Return and reset the counts kept while receiving events"""
+        stats = {'packets_received': self.recv_datagrams,
+                 'wakeups': self.recv_wakeups,
+                 'recv_errors': self.recv_errors,
+                 'stream_connections': self.stream_connections,
+                 'lines_received': self.lines_received}
+        if self.rules:
+            stats['denied'] = self.denied
+            self.denied = 0
+        for kind, count in self.bad_lines.iteritems():
+            stats['bad_lines.%s' % kind] = count
+        for kind, count in self.overflow.iteritems():
+            stats['overflow.%s' % kind] = count
+        if self.key_cache:
+            stats['key_cache.hits'] = self.key_cache.hits
+            stats['key_cache.misses'] = self.key_cache.misses
+            self.key_cache.hits = self.key_cache.misses = 0
+        self.recv_datagrams = self.recv_wakeups = self.lines_received = 0
+        self.recv_errors = 0
+        self.stream_connections = 0
+        self.bad_lines = {}
+        self.overflow = {}
+        return stats
+
+    def internal_stats(self):
+        """
+        Gather statsdpy's own metrics for the interval being flushed.
+
+        Flush timings and graphite stats are those of the previous flush,
+        as the current one hasn't been sent yet.
+
+        :returns: dict of metric name (without self_stats_prefix) to value
+        """
+        stats = self.take_ingest_stats()
+        for name, value in self.worker_ingest.iteritems():
+            stats[name] = stats.get(name, 0) + value
+        self.worker_ingest = {}
+        seen = self.stats_seen - self.last_stats_seen
+        stats['metrics_seen'] = seen if seen >= 0 else self.stats_seen
+        self.last_stats_seen = self.stats_seen
+        stats['keys.counters'] = len(self.counter_keys)
+        stats['keys.timers'] = len(self.timer_keys)
+        stats['keys.gauges'] = len(self.gauge_keys)
+        stats['keys.sets'] = len(self.set_keys)
+        for kind, count in self.expired.iteritems():
+            stats['expired.%s' % kind] = count
+        stats['timer_samples'] = sum(len(timer) for timer in
+                                     self.timers.itervalues())
+        # items(), the asyncio engine builds payloads in another thread
+        for name, value in self.flush_stats.items():
+            stats['flush.%s' % name] = value
+        stats['flush.pending'] = self.flush_queue.qsize()
+        carbon = {}
+        for client in self.carbons.itervalues():
+            for name, value in client.reset_stats().iteritems():
+                if name == 'send_time_max':
+                    carbon[name] = max(carbon.get(name, 0), value)
+                else:
+                    carbon[name] = carbon.get(name, 0) + value
+        for name in ('connects', 'reconnects', 'failures', 'sends', 'bytes'):
+            stats['graphite.%s' % name] = carbon[name]
+        for name in ('connect_time', 'send_time', 'send_time_max'):
+            stats['graphite.%s' % name] = carbon[name] * 1000
+        for backend in self.backends:
+            for name, value in backend.reset_stats().iteritems():
+                if name == 'send_time':
+                    value *= 1000
+                stats['backend.%s.%s' % (backend.name, name)] = value
+        if self.key_cache:
+            stats['key_cache.size'] = len(self.key_cache)
+        if self.spools:
+            for name in ('depth', 'bytes', 'dropped'):
+                stats['spool.%s' % name] = sum(getattr(spool, name) for spool
+                                               in self.spools.itervalues())
+        return stats
+
+    def admit_key(self, keys, key, limit, kind):
+        """
+        Start tracking a new key, unless that would take the number of
+        tracked keys of its type past limit.
+
+        :param dict keys: The tracked keys of the type
+        :param str key: The new key
+        :param int limit: max number of keys of the type, 0 for no limit
+        :param str kind: The type, for the overflow stats
+        :returns: True if the key may be added
+        """
+        if limit and len(keys) >= limit:
+            self.overflow[kind] = self.overflow.get(kind, 0) + 1
+            return False
+        keys[key] = 0
+        return True
+
+    def age_keys(self, updated, keys, ttl, names, metric_names):
+        """
+        Age the tracked keys of a type at flush time.
+
+        :param updated: The keys updated since the last flush
+        :param dict keys: The tracked keys of the type, mapped to the number
+                          of flushes they went without an update
+        :param int ttl: number of flushes a key keeps getting reported
+                        without updates, 0 to keep reporting it forever
+        :param dict names: The name cache of the type, expired keys are
+                           removed from it
+        :param dict metric_names: The backends' name cache of the type,
+                                  likewise
+        :returns: tuple of the new tracked keys and the number that expired
+        """
+        aged = {}
+        expired = 0
+        for key, idle in keys.iteritems():
+            if key in updated:
+                aged[key] = 0
+            elif ttl and idle >= ttl:
+                names.pop(key, None)
+                metric_names.pop(key, None)
+                expired += 1
+            else:
+                aged[key] = idle + 1
+        return aged, expired
+
+    def take_snapshot(self):
+        """
+        Swap in fresh aggregation state and return the state to flush.
+
+        Counter, gauge and set keys that weren't updated keep getting
+        reported (counters as 0, gauges with their last value, sets as None)
+        until they've been idle for their ttl, timers get the emptied storage
+        of the previous snapshot if that has been flushed already. Gauge
+        deltas still pending are applied to the last value of their gauge
+        first.
+
+        :returns: dict with the tstamp, counters, timers, sampled counts,
+                  gauges, sets and internal stats to flush
+        """
+        gauges = self.gauges
+        last = self.gauge_last
+        for key, delta in self.gauge_deltas.iteritems():
+            gauges[key] = gauges.get(key, last.get(key, 0)) + delta
+        self.gauge_deltas = {}
+        timers = self.timers
+        updated = set(key for key, timer in timers.iteritems() if len(timer))
+        window = self.window
+        metric_names = window.metric_names
+        self.counter_keys, expired_counters = self.age_keys(
+            self.counters, self.counter_keys, self.counter_ttl,
+            window.counter_names, metric_names['counters'])
+        self.timer_keys, expired_timers = self.age_keys(
+            updated, self.timer_keys, self.timer_ttl, window.timer_names,
+            metric_names['timers'])
+        self.gauge_keys, expired_gauges = self.age_keys(
+            self.gauges, self.gauge_keys, self.gauge_ttl, window.gauge_names,
+            metric_names['gauges'])
+        self.set_keys, expired_sets = self.age_keys(
+            self.sets, self.set_keys, self.set_ttl, window.set_names,
+            metric_names['sets'])
+        # storage of a timer that expired a flush ago may still have been
+        # swapped back in and got samples without being admitted again
+        for key in updated:
+            if key not in self.timer_keys:
+                self.timer_keys[key] = 0
+        self.expired = {'counters': expired_counters,
+                        'timers': expired_timers,
+                        'gauges': expired_gauges,
+                        'sets': expired_sets}
+        last.update(gauges)
+        if expired_gauges:
+            self.gauge_last = dict((key, last[key]) for key in self.gauge_keys
+                                   if key in last)
+        counters = dict.fromkeys(self.counter_keys, 0)
+        counters.update(self.counters)
+        reported_gauges = dict((key, last[key]) for key in self.gauge_keys
+                               if key in last)
+        sets = dict.fromkeys(self.set_keys)
+        sets.update(self.sets)
+        snapshot = {'tstamp': int(time.time()),
+                    'counters': counters,
+                    'timers': timers,
+                    'sampled_counts': self.sampled_counts,
+                    'gauges': reported_gauges,
+                    'sets': sets,
+                    'internal': self.internal_stats()}
+        self.counters = {}
+        self.sampled_counts = {}
+        self.gauges = {}
+        self.sets = {}
+        self.timers = self.spare_timers
+        self.spare_timers = {}
+        return snapshot
+
+    def roll_up(self, snapshot):
+        """
+        Merge a snapshot into every rollup
+
+        :param dict snapshot: The snapshot just taken
+        :returns: list of the snapshots of the rollups whose window is over
+        """
+        ready = []
+        for rollup in self.rollups:
+            if rollup.add(snapshot):
+                ready.append(rollup.take_snapshot(snapshot['tstamp']))
+        return ready
 
     def stats_flush(self):
         """
         Periodically flush stats to graphite
+
+        Only taking the snapshot happens here, building the payload and
+        talking to graphite is left to flush_sender so a slow graphite never
+        holds up the next snapshot or event processing.
         """
+        eventlet.spawn_n(self.flush_sender)
+        for backend in self.backends:
+            backend.start()
+        for dest in self.spools:
+            self.start_replayer(dest)
         while True:
             try:
                 eventlet.sleep(self.flush_interval)
+                if self.stopping:
+                    return
+                if self.worker_socks:
+                    self.collect_workers()
                 if self.debug:
                     print "seen %d stats so far." % self.stats_seen
                     print "current counters: %s" % self.counters
+                if self.flush_queue.qsize():
+                    self.logger.warning("%d flushes still waiting to be sent"
+                                        % self.flush_queue.qsize())
+                snapshot = self.take_snapshot()
+                if self.debug:
+                    print "internal stats: %s" % snapshot['internal']
+                self.flush_queue.put(snapshot)
+                for rolled_up in self.roll_up(snapshot):
+                    self.flush_queue.put(rolled_up)
+            except: # safety net
+                self.logger.critical('Encountered error in stats_flush loop')
+
+    def flush_sender(self):
+        """
+        Build the payload for each snapshot queued by stats_flush and send
+        it to graphite, after handing its metrics to the output backends
+        """
+        while True:
+            snapshot = self.flush_queue.get()
+            try:
+                if self.backends:
+                    items = self.backend_items(snapshot)
+                    for backend in self.backends:
+                        backend.submit(snapshot['tstamp'], items)
                 if self.pickle_proto:
-                    payload = self.pickle_payload()
-                    if payload:
-                        for batch in payload:
-                            self.report_stats(batch)
+                    payloads = self.pickle_payload(snapshot)
                 else:
-                    payload = self.plain_payload()
-                    if payload:
-                        self.report_stats(payload)
+                    payloads = self.plain_payload(snapshot)
+                batches = [batch for payload in payloads.itervalues()
+                           for batch in payload]
+                flush_stats = snapshot.get('window', self.window).flush_stats
+                flush_stats['batches'] = len(batches)
+                flush_stats['payload_bytes'] = \
+                    sum(len(batch) for batch in batches)
+                if payloads:
+                    self.report_stats(payloads)
             except: # safety net
-                self.logger.critical('Encountered error in stats_flush loop')
+                self.logger.critical('Encountered error in flush_sender loop')
+            if 'window' not in snapshot:
+                self.recycle_timers(snapshot['timers'])
+            self.flush_queue.task_done()
+
+    def final_snapshots(self):
+        """
+        Wrap up the aggregation state on shutdown: checkpoint it into
+        state_file if there is one, otherwise snapshot it (along with the
+        incomplete window of every rollup) for a final flush.
+
+        :returns: list of the snapshots to flush
+        """
+        if self.worker_socks:
+            self.collect_workers(final=True)
+        if self.state_file:
+            self.save_state()
+            return []
+        snapshot = self.take_snapshot()
+        snapshots = [snapshot] + self.roll_up(snapshot)
+        snapshots.extend(rollup.take_snapshot(snapshot['tstamp'])
+                         for rollup in self.rollups if rollup.pending)
+        return snapshots
+
+    def install_signal_handlers(self):
+        """Shut down on SIGTERM, reload on SIGHUP and hand over to a new
+        process on SIGUSR2"""
+        signal.signal(signal.SIGTERM, self.handle_term)
+        signal.signal(signal.SIGHUP, self.handle_hup)
+        signal.signal(signal.SIGUSR2, self.handle_usr2)
+
+    def handle_term(self, signum, frame):
+        """SIGTERM handler, starting the shutdown once however many times
+        we get signalled"""
+        if not self.stopping:
+            self.stopping = True
+            eventlet.spawn_n(self.shutdown)
+
+    def handle_hup(self, signum, frame):
+        """SIGHUP handler, reloading the config"""
+        eventlet.spawn_n(self.reload)
+
+    def handle_usr2(self, signum, frame):
+        """SIGUSR2 handler, handing over to a new process"""
+        if not self.stopping:
+            self.stopping = True
+            eventlet.spawn_n(self.shutdown, True)
+
+    def shutdown(self, hand_over=False):
+        """
+        Flush (or checkpoint) what was aggregated since the last flush, give
+        the flushes still queued up to shutdown_timeout seconds to be sent,
+        and stop.
+
+        :param bool hand_over: once the state is checkpointed, start a new
+                               process taking over the listen sockets
+        """
+        self.logger.info("shutting down")
+        try:
+            snapshots = self.final_snapshots()
+            if hand_over:
+                try:
+                    pid = self.start_successor()
+                    self.logger.info("handed over to pid %d" % pid)
+                except Exception as err:
+                    self.logger.critical("couldn't hand over to a new "
+                                         "process: %s" % err)
+            for snapshot in snapshots:
+                self.flush_queue.put(snapshot)
+            with eventlet.Timeout(self.shutdown_timeout, False):
+                self.flush_queue.join()
+                for backend in self.backends:
+                    backend.join()
+        except: # safety net
+            self.logger.critical('Encountered error shutting down')
+        self.stopped.send()
 
-    def pickle_payload(self):
-        """obtain stats payload in batches of pickle format"""
-        tstamp = int(time.time())
-        payload = []
-
-        for item in self.counters:
-            payload.append(("%s.%s%s" % (self.rate_prefix, item,
-                                         self.rate_suffix),
-                            (tstamp,
-                             self.counters[item] / self.flush_interval)))
-            payload.append(("%s.%s%s" % (self.count_prefix, item,
-                                         self.count_suffix),
-                            (tstamp, self.counters[item])))
-            self.counters[item] = 0
-
-        for key in self.timers:
-            if len(self.timers[key]) > 0:
-                self.process_timer_key(key, tstamp, payload, pickled=True)
-                self.timers[key] = []
-
-        for key in self.gauges:
-            payload.append(("%s.%s" % (self.gauge_prefix, key),
-                            (tstamp, self.gauges[key])))
-            self.gauges[key] = 0
-
-        if payload:
-            batched_payload = []
-            for batch in self._get_batches(payload):
+    def start_successor(self):
+        """
+        Start a new process on our listen sockets: the command line we were
+        started with is run again, so whatever version is installed by now
+        takes over without the sockets ever being closed. Events arriving
+        in the meantime wait in the socket buffers.
+
+        :returns: the pid of the new process
+        :raises: OSError when the new process couldn't be started
+        """
+        if not self.argv:
+            raise OSError("no command line to start a new process with")
+        handed = [(name, sock.fileno()) for name, sock in self.listen_socks]
+        fds = [fd for name, fd in handed]
+        env = dict(os.environ)
+        env[HANDOVER_ENV] = ','.join('%s:%d' % item for item in handed)
+        # closed by a successful exec, otherwise it gets the reason why not
+        readable, writable = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(readable)
+                fcntl.fcntl(writable, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                # the listen sockets are all the new process gets
+                first = 3
+                for fd in sorted(fds + [writable]):
+                    os.closerange(first, fd)
+                    first = fd + 1
+                os.closerange(first, os.sysconf('SC_OPEN_MAX'))
+                for fd in fds:
+                    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(
+                        fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+                os.execve(self.argv[0], self.argv, env)
+            except Exception as err:
+                os.write(writable, str(err))
+            finally:
+                os._exit(1)
+        os.close(writable)
+        try:
+            error = os.read(readable, 4096)
+        finally:
+            os.close(readable)
+        if error:
+            os.waitpid(pid, 0)
+            raise OSError(error)
+        return pid
+
+    def take_over(self, name, family, kind):
+        """
+        Return the listen sockets of a kind handed over by the process that
+        started us, see start_successor
+
+        :param str name: The name they were handed over as
+        :param int family: Their address family
+        :param int kind: Their socket type
+        :returns: list of the sockets, empty when we weren't handed any
+        """
+        socks = []
+        for fd in self.inherited.pop(name, []):
+            socks.append(socket.fromfd(fd, family, kind))
+            os.close(fd)
+            self.logger.info("Took over %s listen socket" % name)
+        return socks
+
+    def close_inherited(self):
+        """Close the handed over sockets the config no longer asks for"""
+        for name, fds in self.inherited.iteritems():
+            self.logger.info("Closing the %s listen socket we were handed "
+                             "over" % name)
+            for fd in fds:
+                os.close(fd)
+        self.inherited = {}
+
+    def reload(self):
+        """
+        Re-read the config file and apply the settings that may change
+        while running (see configure). The others are reported and left
+        alone, they take a restart or a hand over to a new process.
+        """
+        path = self.conf.get('__file__')
+        if not path:
+            self.logger.warning("no config file to reload")
+            return
+        try:
+            conf = readconf(path, 'main')
+        except (Exception, SystemExit) as err:
+            # readconf exits when it can't read the file
+            self.logger.critical("couldn't reload %s, keeping the current "
+                                 "config: %s" % (path, err))
+            return
+        ignored = sorted(
+            key for key in set(conf) | set(self.conf)
+            if key not in self.LIVE_OPTIONS and
+            not key.startswith('rollup_') and
+            conf.get(key) != self.conf.get(key))
+        # configure only rebinds attributes, putting them back undoes it
+        previous = self.__dict__.copy()
+        try:
+            self.configure(conf)
+        except Exception as err:
+            self.__dict__.update(previous)
+            self.logger.critical("invalid config in %s, keeping the current "
+                                 "one: %s" % (path, err))
+            return
+        for dest in self.spools:
+            self.start_replayer(dest)
+        in_use = set(self.carbon_destinations)
+        for rollup in self.rollups:
+            in_use.update(rollup.destinations)
+        for dest, carbon in self.carbons.iteritems():
+            if dest not in in_use:
+                carbon.close()
+        # those set up anew with changed settings
+        for dest, carbon in previous['carbons'].iteritems():
+            if self.carbons[dest] is not carbon:
+                carbon.close()
+        self.logger.info("reloaded %s" % path)
+        if ignored:
+            self.logger.warning("changes to %s need a restart" %
+                                ", ".join(ignored))
+
+    def _pack_timers(self, timers):
+        if self.timer_sketch:
+            return timers
+        # the raw doubles rather than a pickled list of floats
+        return dict((key, timer.tostring()) for key, timer in
+                    timers.iteritems() if len(timer))
+
+    def _unpack_timers(self, timers, sketch):
+        if sketch == self.timer_sketch:
+            if sketch:
+                return timers
+            return dict((key, array('d', samples)) for key, samples in
+                        timers.iteritems())
+        if sketch:
+            self.logger.warning("can't restore sketches as exact timers, "
+                                "dropping %d timers" % len(timers))
+            return {}
+        unpacked = {}
+        for key, samples in timers.iteritems():
+            timer = unpacked[key] = self.new_timer()
+            for value in array('d', samples):
+                timer.append(value)
+        return unpacked
+
+    def save_state(self):
+        """
+        Checkpoint everything aggregated since the last flush, rollups
+        included, into state_file for restore_state to pick up on the next
+        start. The file is written aside and renamed into place, so it's
+        either all there or not there at all.
+        """
+        state = {'time': time.time(),
+                 'timer_sketch': self.timer_sketch,
+                 'counters': self.counters,
+                 'timers': self._pack_timers(self.timers),
+                 'sampled_counts': self.sampled_counts,
+                 'gauges': self.gauges,
+                 'gauge_deltas': self.gauge_deltas,
+                 'gauge_last': self.gauge_last,
+                 'sets': self.sets,
+                 'counter_keys': self.counter_keys,
+                 'timer_keys': self.timer_keys,
+                 'gauge_keys': self.gauge_keys,
+                 'set_keys': self.set_keys,
+                 'rollups': {}}
+        for rollup in self.rollups:
+            state['rollups'][rollup.interval] = {
+                'pending': rollup.pending,
+                'counters': rollup.counters,
+                'timers': self._pack_timers(rollup.timers),
+                'sampled_counts': rollup.sampled_counts,
+                'gauges': rollup.gauges,
+                'sets': rollup.sets}
+        partial_file = self.state_file + '.tmp'
+        with open(partial_file, 'wb') as fp:
+            pickle.dump(state, fp, protocol=-1)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(partial_file, self.state_file)
+        self.logger.info("saved state of %d counters, %d timers, %d gauges "
+                         "and %d sets to %s" %
+                         (len(self.counters), len(self.timers),
+                          len(self.gauges), len(self.sets), self.state_file))
+
+    def restore_state(self):
+        """
+        Load the state checkpointed by save_state, unless it's more than
+        state_max_age seconds old, and remove the file so it's only loaded
+        once.
+        """
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'rb') as fp:
+                state = pickle.load(fp)
+        except Exception as err:
+            self.logger.critical("couldn't load state from %s: %s" %
+                                 (self.state_file, err))
+            state = None
+        os.unlink(self.state_file)
+        if state is None:
+            return
+        age = time.time() - state['time']
+        if age > self.state_max_age:
+            self.logger.warning("ignoring state saved %ds ago" % age)
+            return
+        sketch = state['timer_sketch']
+        self.counters = state['counters']
+        self.timers = self._unpack_timers(state['timers'], sketch)
+        self.sampled_counts = state['sampled_counts']
+        self.gauges = state['gauges']
+        self.gauge_deltas = state['gauge_deltas']
+        self.gauge_last = state['gauge_last']
+        self.sets = state['sets']
+        self.counter_keys = state['counter_keys']
+        self.timer_keys = state['timer_keys']
+        self.gauge_keys = state['gauge_keys']
+        self.set_keys = state['set_keys']
+        for rollup in self.rollups:
+            saved = state['rollups'].get(rollup.interval)
+            if saved:
+                rollup.pending = saved['pending']
+                rollup.counters = saved['counters']
+                rollup.timers = self._unpack_timers(saved['timers'], sketch)
+                rollup.sampled_counts = saved['sampled_counts']
+                rollup.gauges = saved['gauges']
+                rollup.sets = saved['sets']
+        self.logger.info("restored state of %d counters, %d timers, %d "
+                         "gauges and %d sets saved %ds ago" %
+                         (len(self.counters), len(self.timers),
+                          len(self.gauges), len(self.sets), age))
+
+    def pickle_payload(self, snapshot):
+        """obtain stats payload in batches of pickle format
+
+        :param dict snapshot: The state to report, from take_snapshot
+        :returns: dict of graphite destination to list of pickle batches
+        """
+        tstamp = snapshot['tstamp']
+        counters = snapshot['counters']
+        timers = snapshot['timers']
+        sampled = snapshot['sampled_counts']
+        gauges = snapshot['gauges']
+        sets = snapshot['sets']
+        # the timers' stats, when backend_items computed them already
+        computed = snapshot.get('timer_values', {})
+        window = snapshot.get('window', self.window)
+        interval = window.interval
+        cache_names = self.cache_names
+        sharded = window.ring is not None
+        shards = [[] for dest in window.destinations]
+        append = shards[0].append
+        start = time.time()
+
+        names = window.counter_names
+        build = partial(self.counter_output, window)
+        for key, value in self._cooperative(counters.iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            if sharded:
+                self.shard_items(shards, output, tstamp,
+                                 (value / interval, value))
+            else:
+                append((output[0], (tstamp, value / interval)))
+                append((output[1], (tstamp, value)))
+
+        names = window.timer_names
+        build = partial(self.timer_output, window)
+        for key, timer in self._cooperative(timers.iteritems()):
+            if len(timer) > 0:
+                output = names.get(key) or cache_names(names, key, build)
+                values = computed.get(key) or \
+                    self.timer_values(timer, sampled.get(key, 0))
+                if sharded:
+                    self.shard_items(shards, output, tstamp, values)
+                else:
+                    shards[0].extend(zip(output, [(tstamp, value)
+                                                  for value in values]))
+
+        names = window.gauge_names
+        build = partial(self.gauge_output, window)
+        for key, value in self._cooperative(gauges.iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            if sharded:
+                self.shard_items(shards, output, tstamp, (value,))
+            else:
+                append((output[0], (tstamp, value)))
+
+        names = window.set_names
+        build = partial(self.set_output, window)
+        for key, values in self._cooperative(sets.iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            value = len(values) if values is not None else 0
+            if sharded:
+                self.shard_items(shards, output, tstamp, (value,))
+            else:
+                append((output[0], (tstamp, value)))
+
+        if self.self_stats:
+            names = window.self_stat_names
+            build = partial(self.self_stat_output, window)
+            for stat, value in snapshot['internal'].iteritems():
+                output = names.get(stat) or cache_names(names, stat, build)
+                if sharded:
+                    self.shard_items(shards, output, tstamp, (value,))
+                else:
+                    append((output[0], (tstamp, value)))
+
+        built = time.time()
+        window.flush_stats['build_time'] = (built - start) * 1000
+        payloads = {}
+        for dest, payload in zip(window.destinations, shards):
+            if not payload:
+                continue
+            batched_payload = payloads[dest] = []
+            for batch in self._cooperative(self._get_batches(payload)):
                 if self.debug:
                     print "pickling batch: %r" % batch
                 serialized_data = pickle.dumps(batch, protocol=-1)
                 length_prefix = struct.pack("!L", len(serialized_data))
                 batched_payload.append(length_prefix + serialized_data)
-            return batched_payload
-        return None
-
-    def plain_payload(self):
-        """obtain stats payload in plaintext format"""
-        tstamp = int(time.time())
-        payload = []
-        for item in self.counters:
-            payload.append('%s.%s%s %s %s\n' % (self.rate_prefix,
-                                                item,
-                                                self.rate_suffix,
-                                                self.counters[item] /
-                                                self.flush_interval,
-                                                tstamp))
-            payload.append('%s.%s%s %s %s\n' % (self.count_prefix,
-                                                item,
-                                                self.count_suffix,
-                                                self.counters[item],
-                                                tstamp))
-            self.counters[item] = 0
-
-        for key in self.timers:
-            if len(self.timers[key]) > 0:
-                self.process_timer_key(key, tstamp, payload)
-                self.timers[key] = []
-
-        for key in self.gauges:
-            payload.append("%s.%s %d %d\n" % (self.gauge_prefix, key,
-                                              self.gauges[key], tstamp))
-            self.gauges[key] = 0
+        window.flush_stats['serialize_time'] = (time.time() - built) * 1000
+        return payloads
+
+    def plain_payload(self, snapshot):
+        """obtain stats payload in plaintext format
+
+        :param dict snapshot: The state to report, from take_snapshot
+        :returns: dict of graphite destination to a list holding its payload
+        """
+        tstamp = snapshot['tstamp']
+        counters = snapshot['counters']
+        timers = snapshot['timers']
+        sampled = snapshot['sampled_counts']
+        gauges = snapshot['gauges']
+        sets = snapshot['sets']
+        # the timers' stats, when backend_items computed them already
+        computed = snapshot.get('timer_values', {})
+        window = snapshot.get('window', self.window)
+        interval = window.interval
+        cache_names = self.cache_names
+        sharded = window.ring is not None
+        shards = [[] for dest in window.destinations]
+        append = shards[0].append
+        start = time.time()
+
+        names = window.counter_names
+        build = partial(self.counter_output, window)
+        for key, value in self._cooperative(counters.iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            args = (value / interval, tstamp, value, tstamp)
+            if sharded:
+                self.shard_lines(shards, output, args)
+            else:
+                append(output % args)
+
+        names = window.timer_names
+        build = partial(self.timer_output, window)
+        for key, timer in self._cooperative(timers.iteritems()):
+            if len(timer) > 0:
+                output = names.get(key) or cache_names(names, key, build)
+                values = computed.get(key) or \
+                    self.timer_values(timer, sampled.get(key, 0))
+                args = [tstamp] * (2 * len(values))
+                args[::2] = values
+                args = tuple(args)
+                if sharded:
+                    self.shard_lines(shards, output, args)
+                else:
+                    append(output % args)
+
+        names = window.gauge_names
+        build = partial(self.gauge_output, window)
+        for key, value in self._cooperative(gauges.iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            if sharded:
+                self.shard_lines(shards, output, (value, tstamp))
+            else:
+                append(output % (value, tstamp))
+
+        names = window.set_names
+        build = partial(self.set_output, window)
+        for key, values in self._cooperative(sets.iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            value = len(values) if values is not None else 0
+            if sharded:
+                self.shard_lines(shards, output, (value, tstamp))
+            else:
+                append(output % (value, tstamp))
+
+        if self.self_stats:
+            names = window.self_stat_names
+            build = partial(self.self_stat_output, window)
+            for stat, value in snapshot['internal'].iteritems():
+                output = names.get(stat) or cache_names(names, stat, build)
+                if sharded:
+                    self.shard_lines(shards, output, (value, tstamp))
+                else:
+                    append(output % (value, tstamp))
 
         if self.debug:
-            print payload
+            print shards
 
-        if payload:
-            return "".join(payload)
-        else:
-            return None
+        built = time.time()
+        window.flush_stats['build_time'] = (built - start) * 1000
+        payloads = {}
+        for dest, lines in zip(window.destinations, shards):
+            if lines:
+                payloads[dest] = ["".join(lines)]
+        window.flush_stats['serialize_time'] = (time.time() - built) * 1000
+        return payloads
+
+    def backend_items(self, snapshot):
+        """
+        Obtain the metrics of a snapshot for the output backends, which
+        serialize them in their own format.
+
+        The timers' stats are kept in the snapshot as 'timer_values', for
+        the graphite payload to reuse.
+
+        :param dict snapshot: The state to report, from take_snapshot
+        :returns: list of the (name, value) of every metric
+        """
+        counters = snapshot['counters']
+        timers = snapshot['timers']
+        sampled = snapshot['sampled_counts']
+        window = snapshot.get('window', self.window)
+        interval = window.interval
+        cache_names = self.cache_names
+        metric_names = window.metric_names
+        items = []
+        extend = items.extend
+        start = time.time()
+
+        names = metric_names['counters']
+        build = partial(self.metric_names, window, self.counter_metric_names)
+        for key, value in self._cooperative(counters.iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            extend(zip(output, (value / interval, value)))
+
+        computed = snapshot['timer_values'] = {}
+        names = metric_names['timers']
+        build = partial(self.metric_names, window, self.timer_metric_names)
+        for key, timer in self._cooperative(timers.iteritems()):
+            if len(timer) > 0:
+                output = names.get(key) or cache_names(names, key, build)
+                values = computed[key] = \
+                    self.timer_values(timer, sampled.get(key, 0))
+                extend(zip(output, values))
+
+        names = metric_names['gauges']
+        build = partial(self.metric_names, window, self.gauge_metric_names)
+        for key, value in self._cooperative(snapshot['gauges'].iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            extend(zip(output, (value,)))
+
+        names = metric_names['sets']
+        build = partial(self.metric_names, window, self.set_metric_names)
+        for key, values in self._cooperative(snapshot['sets'].iteritems()):
+            output = names.get(key) or cache_names(names, key, build)
+            extend(zip(output, (len(values) if values is not None else 0,)))
+
+        if self.self_stats:
+            names = metric_names['internal']
+            build = partial(self.metric_names, window,
+                            self.self_stat_metric_names)
+            for stat, value in snapshot['internal'].iteritems():
+                output = names.get(stat) or cache_names(names, stat, build)
+                extend(zip(output, (value,)))
+
+        window.flush_stats['backend_build_time'] = (time.time() - start) * 1000
+        return items
 
     def process_gauge(self, key, fields):
         """
@@ -223,16 +1473,71 @@ class StatsdServer(object):
         :param fields: Received fields
         """
         try:
-            self.gauges[key] = float(fields[0])
+            value = float(fields[0])
+            if key in self.gauges or key in self.gauge_keys or \
+                    self.admit_key(self.gauge_keys, key, self.max_gauges,
+                                   'gauges'):
+                if fields[0][:1] in '+-':
+                    if self.gauge_stamps is not None:
+                        self.log_gauge_delta(key, value)
+                    elif key in self.gauges:
+                        self.gauges[key] += value
+                    else:
+                        self.gauge_deltas[key] = \
+                            self.gauge_deltas.get(key, 0) + value
+                else:
+                    self.gauges[key] = value
+                    self.gauge_deltas.pop(key, None)
+                    if self.gauge_stamps is not None:
+                        self.gauge_stamps[key] = time.time()
+                        self.gauge_events.pop(key, None)
             if self.stats_seen >= maxint:
                 self.logger.info("hit maxint, reset seen counter")
                 self.stats_seen = 0
             self.stats_seen += 1
         except Exception as err:
+            self.bad_line('gauge')
             self.logger.info("error decoding gauge event: %s" % err)
             if self.debug:
                 print "error decoding gauge event: %s" % err
 
+    def log_gauge_delta(self, key, delta):
+        """
+        Keep a gauge delta received by a worker along with when it was
+        received, for the coordinator to apply in order with the values
+        other workers got. Deltas received within a millisecond of each
+        other are kept as one.
+
+        :param str key: The gauge's key
+        :param float delta: The change to the gauge's value
+        """
+        now = time.time()
+        events = self.gauge_events.get(key)
+        if events is None:
+            self.gauge_events[key] = [[now, delta]]
+        elif now - events[-1][0] < 0.001:
+            events[-1][1] += delta
+        else:
+            events.append([now, delta])
+
+    def process_set(self, key, fields):
+        """
+        Process a received set event
+
+        :param key: Key of set
+        :param fields: Received fields
+        """
+        if key in self.sets:
+            self.sets[key].add(fields[0])
+        elif key in self.set_keys or \
+                self.admit_key(self.set_keys, key, self.max_sets, 'sets'):
+            self.sets[key] = self.new_set()
+            self.sets[key].add(fields[0])
+        if self.stats_seen >= maxint:
+            self.logger.info("hit maxint, reset seen counter")
+            self.stats_seen = 0
+        self.stats_seen += 1
+
     def process_timer(self, key, fields):
         """
         Process a received timer event
@@ -241,14 +1546,29 @@ class StatsdServer(object):
         :param fields: Received fields
         """
         try:
-            if key not in self.timers:
-                self.timers[key] = []
-            self.timers[key].append(float(fields[0]))
+            value = float(fields[0])
+            sampled = 0
+            if len(fields) == 3:
+                if self.ratecheck.match(fields[2]):
+                    sampled = 1 / float(fields[2].lstrip("@")) - 1
+                else:
+                    raise Exception("bad sample rate.")
+            timer = self.timers.get(key)
+            if timer is None and (key in self.timer_keys or
+                                  self.admit_key(self.timer_keys, key,
+                                                 self.max_timers, 'timers')):
+                timer = self.timers[key] = self.new_timer()
+            if timer is not None:
+                timer.append(value)
+                if sampled:
+                    self.sampled_counts[key] = \
+                        self.sampled_counts.get(key, 0) + sampled
             if self.stats_seen >= maxint:
                 self.logger.info("hit maxint, reset seen counter")
                 self.stats_seen = 0
             self.stats_seen += 1
         except Exception as err:
+            self.bad_line('timer')
             self.logger.info("error decoding timer event: %s" % err)
             if self.debug:
                 print "error decoding timer event: %s" % err
@@ -268,50 +1588,110 @@ class StatsdServer(object):
                 else:
                     raise Exception("bad sample rate.")
             counter_value = float(fields[0] or 1) * (1 / float(sample_rate))
-            if key not in self.counters:
-                self.counters[key] = 0
-            self.counters[key] += counter_value
+            if key in self.counters:
+                self.counters[key] += counter_value
+            elif key in self.counter_keys or \
+                    self.admit_key(self.counter_keys, key, self.max_counters,
+                                   'counters'):
+                self.counters[key] = counter_value
             if self.stats_seen >= maxint:
                 self.logger.info("hit maxint, reset seen counter")
                 self.stats_seen = 0
             self.stats_seen += 1
         except Exception as err:
+            self.bad_line('counter')
             self.logger.info("error decoding counter event: %s" % err)
             if self.debug:
                 print "error decoding counter event: %s" % err
 
-    def process_timer_key(self, key, tstamp, stack, pickled=False):
-        """Append the plain text graphite
+    def _ranked_sums(self, samples, counts):
+        """The list counterpart of LogSketch.ranked_sums
 
-        :param str key: The timer key to process
-        :param int tstamp: The timestamp for the data point
-        :param list stack: The stack of metrics to append the output to
+        :param list samples: The sorted samples
+        :param list counts: ascending list of n, each 1 <= n <= len(samples)
+        :returns: list of (nth smallest sample, sum) tuples, one per n
+        """
+        results = []
+        running = 0
+        prev = 0
+        for n in counts:
+            running += sum(islice(samples, prev, n))
+            prev = n
+            results.append((samples[n - 1], running))
+        return results
 
+    def _ranked_cumsums(self, samples, cumulative, counts):
+        """The numpy counterpart of _ranked_sums
+
+        :param samples: The sorted samples as a numpy array
+        :param cumulative: The cumulative sums of samples
+        :param list counts: ascending list of n, each 1 <= n <= len(samples)
+        :returns: list of (nth smallest sample, sum) tuples, one per n
         """
-        self.timers[key].sort()
-        values = {'count': len(self.timers[key]),
-                  'low': min(self.timers[key]),
-                  'high': max(self.timers[key]),
-                  'total': sum(self.timers[key])}
-        values['mean'] = values['low']
-        nth_percentile = 'upper_%i' % self.pct_threshold
-        values[nth_percentile] = values['high']
+        return [(float(samples[n - 1]), float(cumulative[n - 1]))
+                for n in counts]
 
-        if values['count']:
-            threshold_idx = int(self.threshold_numerator * values['count']) - 1
-            values[nth_percentile] = self.timers[key][threshold_idx]
-            values['mean'] = float(values['total']) / float(values['count'])
+    def timer_values(self, timer, sampled=0):
+        """Return the stats of a timer, in timer_metrics order
 
-        for metric in values:
-            if pickled:
-                stack.append(("%s.%s.%s" % (self.timer_prefix, key, metric),
-                              (tstamp, values[metric])))
-            else:
-                stack.append("%s.%s.%s %s %s\n" % (self.timer_prefix,
-                                                   key,
-                                                   metric,
-                                                   values[metric],
-                                                   tstamp))
+        Every percentile threshold, as well as the median, is taken from a
+        single sort (or sketch walk) and a single pass over the samples. When
+        numpy is available the sort and sums run directly on the sample array.
+
+        :param timer: The timer's samples, at least one
+        :param sampled: events the samples stand for on top of themselves,
+                        due to sample rates. Only added to the count
+        :returns: list of values
+        """
+        count = len(timer)
+        if self.timer_sketch:
+            low, high, total = timer.min, timer.max, timer.total
+            mean = float(total) / count
+            variance = max(timer.total_squares / count - mean * mean, 0.0)
+            ranked_sums = timer.ranked_sums
+        elif numpy:
+            samples = numpy.sort(numpy.frombuffer(timer, dtype=numpy.float64))
+            cumulative = samples.cumsum()
+            low, high = float(samples[0]), float(samples[-1])
+            total = float(cumulative[-1])
+            mean = total / count
+            variance = float(samples.var())
+            ranked_sums = partial(self._ranked_cumsums, samples, cumulative)
+        else:
+            samples = sorted(timer)
+            low, high, total = samples[0], samples[-1], sum(samples)
+            mean = float(total) / count
+            variance = sum((value - mean) ** 2 for value in samples) / count
+            ranked_sums = partial(self._ranked_sums, samples)
+
+        # number of samples within each threshold, thresholds too small to
+        # cover a single sample fall back to covering all of them
+        nums = [int(numerator * count) or count
+                for numerator, suffix in self.pct_thresholds]
+        mid = count // 2
+        wanted = set(nums)
+        wanted.add(mid + 1)
+        if not count % 2:
+            wanted.add(mid)
+        wanted = sorted(wanted)
+        ranked = dict(zip(wanted, ranked_sums(wanted)))
+        if count % 2:
+            median = ranked[mid + 1][0]
+        else:
+            median = (ranked[mid][0] + ranked[mid + 1][0]) / 2.0
+        values = [count + sampled, low, high, total, mean, math.sqrt(variance),
+                  median]
+        for num in nums:
+            upper, num_total = ranked[num]
+            values.extend((upper, num, num_total, float(num_total) / num))
+        return values
+
+    def bad_line(self, kind):
+        """Count a received line we couldn't process
+
+        :param str kind: What was wrong with it
+        """
+        self.bad_lines[kind] = self.bad_lines.get(kind, 0) + 1
 
     def decode_recvd(self, data):
         """
@@ -321,7 +1701,11 @@ class StatsdServer(object):
         """
         bits = data.split(':')
         if len(bits) == 2:
-            key = self.keycheck.sub('_', bits[0])
+            key = self.clean_key(bits[0])
+            if key is None:
+                # dropped by the rules
+                self.denied += 1
+                return
             fields = bits[1].split("|")
             field_count = len(fields)
             if field_count >= 2:
@@ -331,40 +1715,673 @@ class StatsdServer(object):
                         print "got key: %s %r" % (key, fields)
                     processor(key, fields)
                 else:
+                    self.bad_line('type')
                     print "error: unsupported stats type"
                     print "key -> %s\nfields ->%s" % (key, fields)
             else:
+                self.bad_line('fields')
                 print "error (%s): not enough fields received" % key
         else:
+            self.bad_line('invalid')
             print "error: invalid request [%s]" % data[:40]
 
-    def run(self):
-        eventlet.spawn_n(self.stats_flush)
+    def swap_state(self):
+        """Swap in empty aggregation state and return the old state
+
+        :returns: dict of the counters, timers, gauges, sets and stats seen
+                  since the last swap
+        """
+        state = {'counters': self.counters,
+                 'timers': self.timers,
+                 'sampled_counts': self.sampled_counts,
+                 'gauges': self.gauges,
+                 'gauge_stamps': self.gauge_stamps,
+                 'gauge_events': self.gauge_events,
+                 'sets': self.sets,
+                 'stats_seen': self.stats_seen,
+                 'ingest': self.take_ingest_stats()}
+        self.counters = {}
+        self.timers = {}
+        self.sampled_counts = {}
+        self.gauges = {}
+        self.gauge_stamps = {}
+        self.gauge_events = {}
+        self.sets = {}
+        # limits only apply per interval here, the coordinator enforces them
+        # for good
+        self.counter_keys = {}
+        self.timer_keys = {}
+        self.gauge_keys = {}
+        self.set_keys = {}
+        self.stats_seen = 0
+        return state
+
+    def merge_state(self, state):
+        """Merge aggregation state obtained from a worker's swap_state
+
+        Counters are summed, timer samples and set values are combined.
+        A gauge keeps the value with the most recent stamp, and the gauge
+        deltas are gathered for apply_gauge_events once every worker's
+        state is in. New keys count against the key limits like they would
+        have when received.
+
+        :param dict state: The state to merge in
+        """
+        counters = self.counters
+        counter_keys = self.counter_keys
+        for key, value in state['counters'].iteritems():
+            if key in counters:
+                counters[key] += value
+            elif key in counter_keys or \
+                    self.admit_key(counter_keys, key, self.max_counters,
+                                   'counters'):
+                counters[key] = value
+        timers = self.timers
+        timer_keys = self.timer_keys
+        for key, samples in state['timers'].iteritems():
+            if key not in timers:
+                if key not in timer_keys and \
+                        not self.admit_key(timer_keys, key, self.max_timers,
+                                           'timers'):
+                    continue
+                timers[key] = self.new_timer()
+            timers[key].extend(samples)
+        sampled_counts = self.sampled_counts
+        for key, sampled in state['sampled_counts'].iteritems():
+            if key in timers:
+                sampled_counts[key] = sampled_counts.get(key, 0) + sampled
+        gauge_keys = self.gauge_keys
+        stamps = state['gauge_stamps']
+        for key, value in state['gauges'].iteritems():
+            if key not in self.gauges and key not in gauge_keys and \
+                    not self.admit_key(gauge_keys, key, self.max_gauges,
+                                       'gauges'):
+                continue
+            if stamps[key] >= self.gauge_stamps.get(key, 0):
+                self.gauges[key] = value
+                self.gauge_stamps[key] = stamps[key]
+        gauge_events = self.gauge_events
+        for key, events in state['gauge_events'].iteritems():
+            if key in gauge_events:
+                gauge_events[key].extend(events)
+            elif key in self.gauges or key in gauge_keys or \
+                    self.admit_key(gauge_keys, key, self.max_gauges,
+                                   'gauges'):
+                gauge_events[key] = events
+        set_keys = self.set_keys
+        for key, values in state['sets'].iteritems():
+            if key in self.sets:
+                self.sets[key].update(values)
+            elif key in set_keys or \
+                    self.admit_key(set_keys, key, self.max_sets, 'sets'):
+                self.sets[key] = values
+        if self.stats_seen >= maxint - state['stats_seen']:
+            self.logger.info("hit maxint, reset seen counter")
+            self.stats_seen = 0
+        self.stats_seen += state['stats_seen']
+        for name, value in state['ingest'].iteritems():
+            self.worker_ingest[name] = self.worker_ingest.get(name, 0) + value
+
+    def collect_workers(self, final=False):
+        """Pull and merge the aggregation state of every worker process
+
+        :param bool final: have the workers stop receiving and exit after
+                           handing over their state
+        """
+        self.gauge_stamps = {}
+        self.gauge_events = {}
+        for sock in list(self.worker_socks):
+            try:
+                sock.sendall('S' if final else 'F')
+            except Exception as err:
+                self.drop_worker(sock, err)
+        for sock in list(self.worker_socks):
+            try:
+                with eventlet.Timeout(self.worker_timeout):
+                    length = struct.unpack("!L",
+                                           self._recv_exact(sock, 4))[0]
+                    state = pickle.loads(self._recv_exact(sock, length))
+            except (Exception, eventlet.Timeout) as err:
+                self.drop_worker(sock, err)
+                continue
+            self.merge_state(state)
+        self.apply_gauge_events()
+        self.gauge_events = None
+
+    def apply_gauge_events(self):
+        """
+        Apply the gauge deltas merged from the workers as if this process
+        had received every event: only the deltas that came after a
+        gauge's most recent value count, those of gauges without a value
+        are applied at flush time, on top of the gauge's last value.
+        """
+        gauges = self.gauges
+        gauge_deltas = self.gauge_deltas
+        for key, events in self.gauge_events.iteritems():
+            since = self.gauge_stamps.get(key, 0)
+            delta = sum(change for stamp, change in events if stamp > since)
+            if key in gauges:
+                gauges[key] += delta
+            else:
+                gauge_deltas[key] = gauge_deltas.get(key, 0) + delta
+
+    def drop_worker(self, sock, err):
+        """
+        Give up on a worker that died or didn't hand over its state in
+        time: kill it, and close the udp sockets no other worker reads so
+        the kernel stops routing datagrams to them.
+
+        :param sock: The coordinator's end of the worker's control socket
+        :param err: What went wrong talking to the worker
+        """
+        self.logger.critical("lost worker, dropping it: %s" % err)
+        self.worker_socks.remove(sock)
+        sock.close()
+        pid, udp_socks = self.worker_procs.pop(sock)
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        in_use = set(udp_sock for worker_pid, socks in
+                     self.worker_procs.itervalues() for udp_sock in socks)
+        for udp_sock in udp_socks:
+            if udp_sock not in in_use:
+                self.listen_socks.remove(('udp', udp_sock))
+                udp_sock.close()
+        if not self.worker_socks:
+            self.logger.critical("no workers left, udp events are no "
+                                 "longer received")
+
+    def _recv_exact(self, sock, size):
+        """Read exactly size bytes from a stream socket"""
+        chunks = []
+        while size:
+            chunk = sock.recv(size)
+            if not chunk:
+                raise IOError("connection closed")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
+    def serve_coordinator(self, ctl):
+        """
+        Hand our aggregation state to the coordinator whenever it asks.
+
+        :param ctl: The worker's end of the coordinator control socket
+        """
+        while True:
+            command = ctl.recv(1)
+            if not command:
+                # coordinator went away, so should we
+                os._exit(0)
+            if command == 'S':
+                # nothing we receive from now on would get reported
+                self.stopping = True
+            data = pickle.dumps(self.swap_state(), protocol=-1)
+            ctl.sendall(struct.pack("!L", len(data)) + data)
+            if self.stopping:
+                self.stopped.send()
+                return
+
+    def listen_socket(self, reuse_port=False):
+        """Create and bind the udp listen socket"""
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET,
+                            getattr(socket, 'SO_REUSEPORT', 15), 1)
+        if self.recv_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            self.recv_buffer_size)
         addr = (self.listen_addr, self.listen_port)
         sock.bind(addr)
-        buf = 8192
         self.logger.info("Listening on %s:%d" % addr)
         if self.debug:
             print "Listening on %s:%d" % addr
-        while 1:
-            data, addr = sock.recvfrom(buf)
-            if not data:
-                break
+        return sock
+
+    def udp_sockets(self, count=1):
+        """
+        Return the udp listen sockets handed over to us, or else count
+        freshly bound ones, sharing the port with SO_REUSEPORT when there
+        are several
+
+        :param int count: number of sockets to bind
+        """
+        socks = self.take_over('udp', socket.AF_INET, socket.SOCK_DGRAM)
+        if not socks:
+            socks = [self.listen_socket(reuse_port=count > 1)
+                     for i in xrange(count)]
+        self.listen_socks.extend(('udp', sock) for sock in socks)
+        return socks
+
+    def unix_socket(self, path, kind):
+        """Create and bind a unix domain socket, replacing any socket left
+        at path by a previous run
+
+        :param str path: The path to bind to
+        :param int kind: socket.SOCK_DGRAM or socket.SOCK_STREAM
+        """
+        if os.path.exists(path) and S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, kind)
+        sock.bind(path)
+        self.logger.info("Listening on %s" % path)
+        if self.debug:
+            print "Listening on %s" % path
+        return sock
+
+    def extra_listeners(self):
+        """
+        Create and bind the configured tcp and unix domain listeners
+
+        :returns: list of (function reading events from the socket, socket)
+        """
+        listeners = []
+        if self.tcp_listen_port:
+            socks = self.take_over('tcp', socket.AF_INET, socket.SOCK_STREAM)
+            if socks:
+                sock = socks[0]
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                addr = (self.listen_addr, self.tcp_listen_port)
+                sock.bind(addr)
+                sock.listen(socket.SOMAXCONN)
+                self.logger.info("Listening on tcp %s:%d" % addr)
+                if self.debug:
+                    print "Listening on tcp %s:%d" % addr
+            self.listen_socks.append(('tcp', sock))
+            listeners.append((self.accept, sock))
+        if self.unix_stream_socket:
+            socks = self.take_over('unix_stream', socket.AF_UNIX,
+                                   socket.SOCK_STREAM)
+            if socks:
+                sock = socks[0]
             else:
-                for metric in data.splitlines():
-                    if metric:
-                        try:
-                            self.decode_recvd(metric)
-                        except: # safety net
-                            self.logger.critical("exception in decode_recvd")
-                            pass
+                sock = self.unix_socket(self.unix_stream_socket,
+                                        socket.SOCK_STREAM)
+                sock.listen(socket.SOMAXCONN)
+            self.listen_socks.append(('unix_stream', sock))
+            listeners.append((self.accept, sock))
+        if self.unix_dgram_socket:
+            socks = self.take_over('unix_dgram', socket.AF_UNIX,
+                                   socket.SOCK_DGRAM)
+            if socks:
+                sock = socks[0]
+            else:
+                sock = self.unix_socket(self.unix_dgram_socket,
+                                        socket.SOCK_DGRAM)
+            self.listen_socks.append(('unix_dgram', sock))
+            listeners.append((self.receive, sock))
+        return listeners
+
+    def process_stream(self, pending, data):
+        """
+        Process the complete lines of data read from a newline framed
+        stream.
+
+        :param str pending: The incomplete last line of the previous read,
+                            None while skipping the rest of a line that
+                            was too long
+        :param str data: The data read
+        :returns: the incomplete last line of this read, to pass along with
+                  the next one
+        """
+        if pending is None:
+            start = data.find('\n')
+            if start < 0:
+                return None
+            data = data[start + 1:]
+            pending = ''
+        end = data.rfind('\n')
+        if end < 0:
+            pending += data
+        else:
+            self.process_batch([pending + data[:end]])
+            pending = data[end + 1:]
+        if len(pending) > self.stream_max_line:
+            self.bad_line('too_long')
+            return None
+        return pending
+
+    def accept(self, sock):
+        """Accept stream connections forever, reading events from each in
+        its own green thread"""
+        while True:
+            trampoline(sock, read=True)
+            if self.stopping:
+                # leave the backlog to whoever takes over the socket
+                return
+            try:
+                conn, addr = sock.accept()
+            except socket.error as err:
+                self.logger.critical("error accepting connection: %s" % err)
+                # eg out of file descriptors, let connections close first
+                eventlet.sleep(1)
+                continue
+            self.stream_connections += 1
+            eventlet.spawn_n(self.receive_stream, conn)
+
+    def receive_stream(self, conn):
+        """Read and process newline framed events from a stream
+        connection until the client closes it"""
+        pending = ''
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data or self.stopping:
+                    break
+                self.recv_wakeups += 1
+                pending = self.process_stream(pending, data)
+        except socket.error as err:
+            self.logger.info("error reading stream: %s" % err)
+        finally:
+            conn.close()
+        if pending:
+            self.process_batch([pending])
+
+    def decode_lines(self, datagrams):
+        """
+        Decode and process each line of a batch of datagrams separately
+        with decode_recvd.
+
+        :param list datagrams: The datagrams to process
+        """
+        for data in datagrams:
+            for metric in data.splitlines():
+                if metric:
+                    self.lines_received += 1
+                    try:
+                        self.decode_recvd(metric)
+                    except: # safety net
+                        self.bad_line('exception')
+                        self.logger.critical("exception in decode_recvd")
+                        pass
+
+    def process_batch(self, datagrams):
+        """
+        Decode and process a batch of received datagrams.
+
+        Well formed counter, timer, gauge and set lines are handled inline in
+        a single pass over the batch, with the stats seen counter updated
+        once per batch. Anything else (bad lines included) goes through
+        decode_recvd, so results and error handling match decode_lines.
+
+        :param list datagrams: The datagrams to process
+        """
+        if self.debug:
+            return self.decode_lines(datagrams)
+        counters = self.counters
+        timers = self.timers
+        gauges = self.gauges
+        gauge_stamps = self.gauge_stamps
+        gauge_deltas = self.gauge_deltas
+        sampled_counts = self.sampled_counts
+        sets = self.sets
+        counter_keys = self.counter_keys
+        timer_keys = self.timer_keys
+        gauge_keys = self.gauge_keys
+        set_keys = self.set_keys
+        admit_key = self.admit_key
+        clean_key = self.clean_key
+        seen = 0
+        lines = 0
+        denied = 0
+        for data in datagrams:
+            for metric in data.splitlines():
+                if not metric:
+                    continue
+                lines += 1
+                raw_key, sep, rest = metric.partition(':')
+                fields = rest.split('|')
+                if sep and len(fields) >= 2 and ':' not in rest:
+                    kind = fields[1]
+                    key = clean_key(raw_key)
+                    if key is None:
+                        # dropped by the rules
+                        denied += 1
+                        continue
+                    try:
+                        if kind == 'c':
+                            value = float(fields[0] or 1)
+                            if len(fields) == 3:
+                                rate = fields[2]
+                                if rate[:1] != '@' or \
+                                        rate[1:2] not in '0123456789.':
+                                    raise ValueError()
+                                value *= 1 / float(rate[1:])
+                            if key in counters:
+                                counters[key] += value
+                            elif key in counter_keys or \
+                                    admit_key(counter_keys, key,
+                                              self.max_counters, 'counters'):
+                                counters[key] = value
+                        elif kind == 'ms':
+                            value = float(fields[0])
+                            sampled = 0
+                            if len(fields) == 3:
+                                rate = fields[2]
+                                if rate[:1] != '@' or \
+                                        rate[1:2] not in '0123456789.':
+                                    raise ValueError()
+                                sampled = 1 / float(rate[1:]) - 1
+                            timer = timers.get(key)
+                            if timer is None and (
+                                    key in timer_keys or
+                                    admit_key(timer_keys, key,
+                                              self.max_timers, 'timers')):
+                                timer = timers[key] = self.new_timer()
+                            if timer is not None:
+                                timer.append(value)
+                                if sampled:
+                                    sampled_counts[key] = \
+                                        sampled_counts.get(key, 0) + sampled
+                        elif kind == 'g':
+                            value = float(fields[0])
+                            if key in gauges or key in gauge_keys or \
+                                    admit_key(gauge_keys, key,
+                                              self.max_gauges, 'gauges'):
+                                if fields[0][:1] in '+-':
+                                    if gauge_stamps is not None:
+                                        self.log_gauge_delta(key, value)
+                                    elif key in gauges:
+                                        gauges[key] += value
+                                    else:
+                                        gauge_deltas[key] = \
+                                            gauge_deltas.get(key, 0) + value
+                                else:
+                                    gauges[key] = value
+                                    if gauge_deltas:
+                                        gauge_deltas.pop(key, None)
+                                    if gauge_stamps is not None:
+                                        gauge_stamps[key] = time.time()
+                                        self.gauge_events.pop(key, None)
+                        elif kind == 's':
+                            if key in sets:
+                                sets[key].add(fields[0])
+                            elif key in set_keys or \
+                                    admit_key(set_keys, key,
+                                              self.max_sets, 'sets'):
+                                sets[key] = self.new_set()
+                                sets[key].add(fields[0])
+                        else:
+                            raise ValueError()
+                        seen += 1
+                        continue
+                    except Exception:
+                        pass
+                # not a simple well formed event, leave it to decode_recvd
+                try:
+                    self.decode_recvd(metric)
+                except: # safety net
+                    self.bad_line('exception')
+                    self.logger.critical("exception in decode_recvd")
+        self.lines_received += lines
+        self.denied += denied
+        if self.stats_seen >= maxint - seen:
+            self.logger.info("hit maxint, reset seen counter")
+            self.stats_seen = 0
+        self.stats_seen += seen
+
+    def receive(self, sock):
+        """
+        Read and process events from sock forever.
+
+        Rather than doing a green recvfrom per datagram we wait once for the
+        socket to become readable and then drain up to recv_batch_size
+        datagrams from the non-blocking socket before going back to the hub.
+        """
+        buf = self.max_datagram_size
+        batch_size = self.recv_batch_size
+        # the green socket's underlying (already non-blocking) socket
+        recv = sock.fd.recv
+        fileno = sock.fileno()
+        while 1:
+            trampoline(fileno, read=True)
+            if self.stopping:
+                # leave what's queued to whoever takes over the socket
+                return
+            batch = []
+            try:
+                while len(batch) < batch_size:
+                    data = recv(buf)
+                    if data:
+                        batch.append(data)
+            except socket.error as err:
+                if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # the socket is still good to read from, whatever went
+                    # wrong with this datagram
+                    self.recv_errors += 1
+                    self.logger.critical("error receiving: %s" % err)
+                    if not batch:
+                        # don't spin on an error that doesn't clear
+                        eventlet.sleep(0.1)
+            self.recv_wakeups += 1
+            self.recv_datagrams += len(batch)
+            self.process_batch(batch)
+
+    def run_worker(self, ctl, udp_socks, listeners=()):
+        """Run as a worker process sharing the listen port with its peers
+
+        :param ctl: The worker's end of the coordinator control socket
+        :param list udp_socks: The udp listen sockets to receive from
+        :param list listeners: extra_listeners, shared by all workers
+        """
+        self.gauge_stamps = {}
+        self.gauge_events = {}
+        eventlet.spawn_n(self.serve_coordinator, ctl)
+        for receive, sock in listeners:
+            eventlet.spawn_n(receive, sock)
+        for sock in udp_socks:
+            eventlet.spawn_n(self.receive, sock)
+        self.stopped.wait()
+
+    def run_coordinator(self):
+        """
+        Fork self.workers worker processes, then merge their state and
+        report it every flush. All listen sockets are bound before forking:
+        each worker gets its own udp socket on the listen port (with
+        SO_REUSEPORT) while the tcp and unix domain listeners are shared by
+        all of them. Udp sockets handed over by a previous process are
+        shared out between the workers instead.
+        """
+        listeners = self.extra_listeners()
+        udp_socks = self.udp_sockets(self.workers)
+        self.close_inherited()
+        for i in xrange(self.workers):
+            worker_udp = udp_socks[i::self.workers] or \
+                [udp_socks[i % len(udp_socks)]]
+            ours, theirs = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                # we go when the coordinator does, after it got our state
+                for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR2):
+                    signal.signal(signum, signal.SIG_IGN)
+                ours.close()
+                for sock in self.worker_socks:
+                    sock.close()
+                self.worker_socks = []
+                self.worker_procs = {}
+                # the kernel only stops routing datagrams to the udp
+                # sockets of a dead worker once nobody holds them open
+                for sock in udp_socks:
+                    if sock not in worker_udp:
+                        sock.close()
+                try:
+                    self.run_worker(theirs, worker_udp, listeners)
+                finally:
+                    os._exit(0)
+            theirs.close()
+            self.worker_socks.append(ours)
+            self.worker_procs[ours] = (pid, worker_udp)
+        # after forking, or every worker would report the restored state
+        self.restore_state()
+        self.install_signal_handlers()
+        self.logger.info("Started %d workers" % self.workers)
+        if self.debug:
+            print "Started %d workers" % self.workers
+        eventlet.spawn_n(self.stats_flush)
+        self.stopped.wait()
+
+    def run(self):
+        if self.workers > 1:
+            return self.run_coordinator()
+        self.restore_state()
+        self.install_signal_handlers()
+        for receive, sock in self.extra_listeners():
+            eventlet.spawn_n(receive, sock)
+        for sock in self.udp_sockets():
+            eventlet.spawn_n(self.receive, sock)
+        self.close_inherited()
+        eventlet.spawn_n(self.stats_flush)
+        self.stopped.wait()
+
+
+def parse_destinations(value):
+    """Parse a comma separated list of host:port[:instance]
+
+    :returns: list of (host, port, instance) tuples, instance is None when
+              not given
+    """
+    destinations = []
+    for item in value.split(','):
+        item = item.strip()
+        if item:
+            parts = item.split(':')
+            if len(parts) not in (2, 3):
+                raise ValueError("bad destination %r, expected "
+                                 "host:port[:instance]" % item)
+            instance = parts[2] if len(parts) == 3 else None
+            destinations.append((parts[0], int(parts[1]), instance))
+    return destinations
+
+
+def make_server(conf):
+    """Return the server for the configured mode (aggregate or relay) and
+    engine (eventlet or asyncio)
+
+    :param dict conf: The configuration data
+    """
+    engine = conf.get('engine', 'eventlet')
+    if engine not in ('eventlet', 'asyncio'):
+        raise ValueError("unknown engine %r" % engine)
+    if conf.get('mode', 'aggregate') == 'relay':
+        if engine != 'eventlet':
+            raise ValueError("relay mode needs the eventlet engine")
+        from statsdpy.relay import StatsdRelay
+        return StatsdRelay(conf)
+    if engine == 'asyncio':
+        from statsdpy.aio import AsyncioStatsdServer
+        return AsyncioStatsdServer(conf)
+    return StatsdServer(conf)
 
 
 class Statsd(Daemon):
 
-    def run(self, conf):
-        server = StatsdServer(conf)
+    def run(self, conf, argv=None):
+        server = make_server(conf)
+        server.argv = argv
         server.run()
 
 
@@ -391,10 +2408,20 @@ def run_server():
         args.print_help()
         sys.exit(1)
 
+    # daemons run from /, and reload their config or start the process they
+    # hand over to from there
+    options.conf = os.path.abspath(options.conf)
+    options.pid = os.path.abspath(options.pid)
+    argv = [sys.executable, os.path.abspath(sys.argv[0]), 'start',
+            '--conf=%s' % options.conf, '--pid=%s' % options.pid]
+    if options.foreground:
+        argv.append('--foreground')
+
     if options.foreground:
         print "Running in foreground."
-        conf = readconf(options.conf)
-        statsd = StatsdServer(conf['main'])
+        conf = readconf(options.conf, 'main')
+        statsd = make_server(conf)
+        statsd.argv = argv
         try:
             statsd.run()
         except KeyboardInterrupt:
@@ -404,8 +2431,12 @@ def run_server():
     if len(sys.argv) >= 2:
         statsdaemon = Statsd(options.pid)
         if 'start' == sys.argv[1]:
-            conf = readconf(options.conf)
-            statsdaemon.start(conf['main'])
+            conf = readconf(options.conf, 'main')
+            if HANDOVER_ENV in os.environ:
+                # the daemon in the pidfile is handing over to us
+                statsdaemon.take_over(conf, argv)
+            else:
+                statsdaemon.start(conf, argv)
         elif 'stop' == sys.argv[1]:
             statsdaemon.stop()
         elif 'restart' == sys.argv[1]:
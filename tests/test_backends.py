@@ -0,0 +1,184 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import eventlet
+import eventlet.wsgi
+from eventlet.green import socket
+
+from statsdpy.backends import make_backend
+from tests.test_statsd import StatsdTestCase
+
+ITEMS = [('stats.a', 1.5), ('stats_counts.a', 15), ('stats.gauges.g', 7),
+         ('stats.timers.t.upper_90', 250.0)]
+LINES = ['stats.a 1.5 1000', 'stats_counts.a 15 1000', 'stats.gauges.g 7 1000',
+         'stats.timers.t.upper_90 250.0 1000']
+
+
+class BackendTestCase(unittest.TestCase):
+
+    def backend(self, name, **options):
+        backend = make_backend(name, options, logging.getLogger('test'))
+        backend.start()
+        return backend
+
+    def flush(self, backend, items=ITEMS, tstamp=1000):
+        backend.submit(tstamp, items)
+        with eventlet.Timeout(5):
+            backend.join()
+
+
+class TestCarbonUDP(BackendTestCase):
+
+    def test_packets(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        backend = self.backend('udp', type='carbon_udp',
+                               port=str(listener.getsockname()[1]),
+                               packet_size='50', batch_size='2')
+        self.flush(backend)
+        packets = []
+        received = []
+        while len(received) < len(LINES):
+            packets.append(listener.recv(1500))
+            received.extend(packets[-1].splitlines())
+        listener.close()
+        self.assertEqual(received, LINES)
+        # lines aren't split over packets, which are filled up to the size
+        self.assertEqual([len(packet) for packet in packets], [40, 22, 35])
+        self.assertEqual(backend.stats['batches'], 2)
+        self.assertEqual(backend.stats['bytes'], 40 + 22 + 35)
+
+
+class TestInfluxDB(BackendTestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.status = '204 No Content'
+        self.listener = eventlet.listen(('127.0.0.1', 0))
+        self.server = eventlet.spawn(
+            eventlet.wsgi.server, self.listener, self.app,
+            log=StringIO())
+
+    def tearDown(self):
+        self.server.kill()
+        self.listener.close()
+
+    def app(self, env, start_response):
+        body = env['wsgi.input'].read()
+        if env.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        self.requests.append({'path': env['PATH_INFO'],
+                              'query': env['QUERY_STRING'],
+                              'auth': env.get('HTTP_AUTHORIZATION'),
+                              'port': env['REMOTE_PORT'],
+                              'body': body})
+        start_response(self.status, [])
+        return ['bad request' if self.status[0] != '2' else '']
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.listener.getsockname()[1],
+                                          path)
+
+    def test_line_protocol(self):
+        backend = self.backend('influx', type='influxdb', batch_size='3',
+                               url=self.url('/api/v2/write?bucket=b'),
+                               token='secret')
+        self.flush(backend)
+        self.flush(backend, ITEMS[:1], 1001)
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(
+            ''.join(request['body'] for request in self.requests),
+            'stats.a value=1.5 1000000000000\n'
+            'stats_counts.a value=15 1000000000000\n'
+            'stats.gauges.g value=7 1000000000000\n'
+            'stats.timers.t.upper_90 value=250.0 1000000000000\n'
+            'stats.a value=1.5 1001000000000\n')
+        for request in self.requests:
+            self.assertEqual(request['path'], '/api/v2/write')
+            self.assertEqual(request['query'], 'bucket=b')
+            self.assertEqual(request['auth'], 'Token secret')
+        # over a single keep alive connection
+        self.assertEqual(len(set(request['port']
+                                 for request in self.requests)), 1)
+        self.assertEqual(backend.stats['failures'], 0)
+
+    def test_error_status(self):
+        self.status = '400 Bad Request'
+        backend = self.backend('influx', type='influxdb', gzip_level='0',
+                               url=self.url('/write?db=statsd'))
+        self.flush(backend)
+        self.assertEqual(self.requests[0]['body'].count('\n'), len(ITEMS))
+        self.assertEqual(backend.stats['failures'], 1)
+        self.assertEqual(backend.stats['batches'], 0)
+        self.assertTrue(backend.failing)
+
+
+class TestFile(BackendTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append_and_rotate(self):
+        path = os.path.join(self.path, 'archive', 'statsd.log')
+        backend = self.backend('archive', type='file', path=path,
+                               max_bytes='100', max_files='2')
+        self.flush(backend)
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(), LINES)
+        # rotated once past max_bytes, keeping at most max_files
+        for tstamp in xrange(1001, 1005):
+            self.flush(backend, tstamp=tstamp)
+        rotated = sorted(name for name in os.listdir(os.path.dirname(path))
+                         if name != 'statsd.log')
+        self.assertEqual(len(rotated), 2)
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(),
+                             [line[:-4] + '1004' for line in LINES])
+
+
+class TestServerBackends(StatsdTestCase):
+
+    def metrics(self, lines):
+        metrics = {}
+        for line in lines.splitlines():
+            name, value, tstamp = line.split()
+            metrics[name] = (float(value), int(tstamp))
+        return metrics
+
+    def test_same_metrics_as_graphite(self):
+        path = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(path, 'statsd.log')
+            server = self.server(backends='archive',
+                                 backend_archive_type='file',
+                                 backend_archive_path=archive)
+            server.process_batch(['a:1|c', 't:10|ms', 't:20|ms', 'g:5|g',
+                                  's:x|s'])
+            snapshot = server.take_snapshot()
+            backend = server.backends[0]
+            backend.start()
+            backend.submit(snapshot['tstamp'], server.backend_items(snapshot))
+            with eventlet.Timeout(5):
+                backend.join()
+            graphite = ''.join(batch for batches in
+                               server.plain_payload(snapshot).itervalues()
+                               for batch in batches)
+            with open(archive) as f:
+                archived = f.read()
+            # as numbers, graphite's plaintext has gauges as integers
+            self.assertEqual(self.metrics(archived), self.metrics(graphite))
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
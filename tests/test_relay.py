@@ -0,0 +1,70 @@
+import os
+import signal
+import unittest
+
+import eventlet
+from eventlet.green import socket
+
+from statsdpy.relay import StatsdRelay
+from tests.test_statsd import StatsdTestCase
+
+
+class TestRelay(StatsdTestCase):
+
+    def setUp(self):
+        StatsdTestCase.setUp(self)
+        self.handlers = dict((signum, signal.getsignal(signum)) for signum in
+                             (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR2))
+        # the instance relayed to
+        self.downstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.downstream.bind(('127.0.0.1', 0))
+        self.downstream.settimeout(5)
+
+    def tearDown(self):
+        self.downstream.close()
+        for signum, handler in self.handlers.iteritems():
+            signal.signal(signum, handler)
+        StatsdTestCase.tearDown(self)
+
+    def relay(self, **conf):
+        conf.setdefault('listen_port', '0')
+        conf['relay_destinations'] = '127.0.0.1:%d' % \
+            self.downstream.getsockname()[1]
+        relay = StatsdRelay(conf)
+        thread = eventlet.spawn(relay.run)
+        eventlet.sleep(0.1)
+        return relay, thread
+
+    def test_signals(self):
+        relay, thread = self.relay()
+        sock = dict(relay.listen_socks)['udp']
+        os.kill(os.getpid(), signal.SIGHUP)
+        eventlet.sleep(0.1)
+        # still relaying after a reload was asked for
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto('a:1|c', sock.getsockname())
+        client.close()
+        self.assertEqual(self.downstream.recv(1500), 'a:1|c')
+        os.kill(os.getpid(), signal.SIGTERM)
+        with eventlet.Timeout(5):
+            thread.wait()
+        self.assertTrue(relay.stopping)
+
+    def test_stream_listener(self):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        relay, thread = self.relay(tcp_listen_port=str(port))
+        client = socket.create_connection(('127.0.0.1', port))
+        client.sendall('a:1|c\nb:2|c\n')
+        client.close()
+        received = self.downstream.recv(1500)
+        self.assertEqual(received, 'a:1|c\nb:2|c')
+        relay.handle_term(signal.SIGTERM, None)
+        with eventlet.Timeout(5):
+            thread.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from statsdpy.rollup import FlushWindow
+
+
+class TestFlushWindow(unittest.TestCase):
+
+    def test_same_shards_as_carbon_relay(self):
+        destinations = [('10.0.0.%d' % i, 2004, 'abcdefg'[i])
+                        for i in range(1, 7)]
+        window = FlushWindow(10, destinations)
+        # as assigned by carbon 1.1.10's consistent-hashing relay given the
+        # same destinations, the first three where positions of different
+        # destinations collide
+        expected = {'stats.k734': ('10.0.0.3', 'd'),
+                    'stats.k2857': ('10.0.0.3', 'd'),
+                    'stats.k5044': ('10.0.0.3', 'd'),
+                    'stats.k0': ('10.0.0.6', 'g'),
+                    'stats.k1': ('10.0.0.5', 'f'),
+                    'stats.gauges.queue_depth': ('10.0.0.1', 'b'),
+                    'stats_counts.api.hits': ('10.0.0.1', 'b')}
+        for name, node in expected.iteritems():
+            dest = destinations[window.node(name)]
+            self.assertEqual((dest[0], dest[2]), node)
+
+    def test_same_host_needs_instances(self):
+        self.assertRaises(ValueError, FlushWindow, 10,
+                          [('10.0.0.1', 2004, None), ('10.0.0.1', 2104, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
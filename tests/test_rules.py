@@ -0,0 +1,41 @@
+import unittest
+
+from statsdpy.rules import KeyRules, parse_rule
+
+
+class TestKeyRules(unittest.TestCase):
+
+    def test_first_match_applies(self):
+        rules = KeyRules([parse_rule(r'deny ^debug\.'),
+                          parse_rule(r'rewrite \.host-[0-9]+\. .'),
+                          parse_rule(r'aggregate ^api\. api.all')])
+        self.assertNotEqual(rules.any_rule, None)
+        self.assertEqual(rules.apply('debug.host-1.x'), None)
+        self.assertEqual(rules.apply('web.host-12.hits'), 'web.hits')
+        self.assertEqual(rules.apply('api.host-1.hits'), 'api.hits')
+        self.assertEqual(rules.apply('api.hits'), 'api.all')
+        self.assertEqual(rules.apply('other.hits'), 'other.hits')
+
+    def test_backreferences(self):
+        rules = KeyRules([('deny', r'^(x)y', None),
+                          ('rewrite', r'\.(\w+)\.\1\.', '.dup.')])
+        self.assertEqual(rules.any_rule, None)
+        self.assertEqual(rules.apply('a.foo.foo.b'), 'a.dup.b')
+        self.assertEqual(rules.apply('xy.foo'), None)
+        self.assertEqual(rules.apply('a.foo.bar.b'), 'a.foo.bar.b')
+        rules = KeyRules([('deny', r'(?P<a>x)y', None),
+                          ('deny', r'\.(?P<b>\w+)\.(?P=b)\.', None)])
+        self.assertEqual(rules.apply('a.foo.foo.b'), None)
+
+    def test_escaped_backslash_is_no_backreference(self):
+        rules = KeyRules([('deny', r'(a)\\1', None)])
+        self.assertNotEqual(rules.any_rule, None)
+        self.assertEqual(rules.apply('a\\1'), None)
+
+    def test_bad_rule(self):
+        self.assertRaises(ValueError, parse_rule, 'rewrite a')
+        self.assertRaises(ValueError, parse_rule, 'drop a')
+
+
+if __name__ == '__main__':
+    unittest.main()
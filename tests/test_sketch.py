@@ -0,0 +1,81 @@
+import random
+import unittest
+
+from statsdpy.sketch import LogSketch
+
+
+class TestLogSketch(unittest.TestCase):
+
+    def samples(self, count, seed=1):
+        rand = random.Random(seed)
+        # spanning several orders of magnitude, with some negatives and
+        # zeros thrown in
+        samples = [rand.lognormvariate(3, 2) for i in xrange(count)]
+        samples.extend(-rand.expovariate(0.1) for i in xrange(count // 10))
+        samples.extend([0.0] * (count // 20))
+        rand.shuffle(samples)
+        return samples
+
+    def assertWithin(self, estimate, exact, accuracy):
+        # a little slack for floating point rounding
+        self.assertTrue(abs(estimate - exact) <= accuracy * abs(exact) + 1e-9,
+                        "%r not within %r of %r" % (estimate, accuracy, exact))
+
+    def check_ranks(self, sketch, samples, ranks=None):
+        ordered = sorted(samples)
+        for rank in ranks or xrange(len(ordered)):
+            self.assertWithin(sketch.value_at(rank), ordered[rank],
+                              sketch.relative_accuracy)
+
+    def test_relative_error_bound(self):
+        for accuracy in (0.01, 0.05):
+            samples = self.samples(5000)
+            sketch = LogSketch(accuracy)
+            for value in samples:
+                sketch.append(value)
+            self.check_ranks(sketch, samples)
+            self.assertEqual(len(sketch), len(samples))
+            self.assertEqual(sketch.min, min(samples))
+            self.assertEqual(sketch.max, max(samples))
+            self.assertAlmostEqual(sketch.total, sum(samples))
+
+    def test_ranked_sums(self):
+        samples = [abs(value) for value in self.samples(2000)]
+        sketch = LogSketch(0.01)
+        sketch.extend(LogSketch())
+        for value in samples:
+            sketch.append(value)
+        ordered = sorted(samples)
+        counts = [1, 10, len(ordered) // 2, len(ordered) * 9 // 10,
+                  len(ordered)]
+        for n, (value, total) in zip(counts, sketch.ranked_sums(counts)):
+            self.assertWithin(value, ordered[n - 1], 0.01)
+            # every sample in the sum is within the bound too
+            self.assertWithin(total, sum(ordered[:n]), 0.01)
+
+    def test_merged_sketches(self):
+        samples = self.samples(3000)
+        merged = LogSketch(0.02)
+        for seed in xrange(3):
+            sketch = LogSketch(0.02)
+            for value in samples[seed::3]:
+                sketch.append(value)
+            merged.extend(sketch)
+        self.check_ranks(merged, samples)
+        self.assertEqual(len(merged), len(samples))
+
+    def test_collapsed_buckets_keep_high_ranks(self):
+        samples = [10 ** (i / 100.0) for i in xrange(-600, 600)]
+        sketch = LogSketch(0.01, max_bins=100)
+        for value in samples:
+            sketch.append(value)
+        self.assertTrue(len(sketch.bins) <= 100)
+        # only the samples folded into the lowest bucket lose accuracy,
+        # those in the 99 buckets above it keep it
+        lowest = max(samples) / sketch.gamma ** 98
+        self.check_ranks(sketch, samples, [
+            rank for rank, value in enumerate(samples) if value > lowest])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from statsdpy.spool import HEADER, Spool
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.path, name))
+                   for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def test_fifo(self):
+        spool = Spool(self.path)
+        for data in ('a', 'bb', 'ccc'):
+            spool.append(data)
+        self.assertEqual(spool.depth, 3)
+        self.assertEqual(spool.peek(), 'a')
+        spool.pop()
+        # a restart resumes where the replay left off
+        spool = Spool(self.path)
+        self.assertEqual(spool.depth, 2)
+        self.assertEqual(spool.peek(), 'bb')
+        spool.pop()
+        self.assertEqual(spool.peek(), 'ccc')
+        spool.pop()
+        self.assertEqual(spool.peek(), None)
+        self.assertEqual(spool.depth, 0)
+
+    def test_max_bytes_with_one_segment(self):
+        record = HEADER.size + 10
+        spool = Spool(self.path, max_bytes=record * 3,
+                      segment_bytes=record * 100)
+        for i in range(10):
+            spool.append('%010d' % i)
+            self.assertTrue(spool.bytes <= spool.max_bytes)
+            self.assertTrue(self.size() <= spool.max_bytes)
+        self.assertEqual(spool.dropped + spool.depth, 10)
+        self.assertEqual(spool.peek(), '%010d' % (10 - spool.depth))
+
+    def test_payload_over_max_bytes(self):
+        spool = Spool(self.path, max_bytes=HEADER.size + 10)
+        spool.append('x' * 11)
+        self.assertEqual(spool.depth, 0)
+        self.assertEqual(spool.dropped, 1)
+        self.assertEqual(self.size(), 0)
+        spool.append('y' * 10)
+        self.assertEqual(spool.peek(), 'y' * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
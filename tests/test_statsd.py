@@ -0,0 +1,369 @@
+import cPickle as pickle
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from StringIO import StringIO
+
+import eventlet
+from eventlet.green import socket
+
+from statsdpy import statsd
+from statsdpy.daemonutils import readconf
+
+
+class StatsdTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # no syslog to log to when testing
+        self.syslog_handler = statsd.SysLogHandler
+        statsd.SysLogHandler = lambda address: logging.NullHandler()
+
+    def tearDown(self):
+        statsd.SysLogHandler = self.syslog_handler
+
+    def server(self, **conf):
+        conf.setdefault('self_stats', 'no')
+        return statsd.StatsdServer(conf)
+
+
+class TestWorkerGauges(StatsdTestCase):
+
+    def worker(self):
+        worker = self.server()
+        worker.gauge_stamps = {}
+        worker.gauge_events = {}
+        return worker
+
+    def flush(self, events):
+        """Feed (worker index, line) events to two workers and to a single
+        process, and return the gauges the coordinator and the single
+        process each flush"""
+        workers = [self.worker(), self.worker()]
+        single = self.server()
+        for index, line in events:
+            workers[index].process_batch([line])
+            single.process_batch([line])
+            # further apart than the deltas workers keep as one
+            time.sleep(0.002)
+        coordinator = self.server()
+        coordinator.gauge_stamps = {}
+        coordinator.gauge_events = {}
+        for worker in workers:
+            coordinator.merge_state(worker.swap_state())
+        coordinator.apply_gauge_events()
+        coordinator.gauge_events = None
+        return (coordinator.take_snapshot()['gauges'],
+                single.take_snapshot()['gauges'])
+
+    def test_delta_before_value(self):
+        merged, single = self.flush([(0, 'g:+3|g'), (1, 'g:10|g')])
+        self.assertEqual(single, {'g': 10})
+        self.assertEqual(merged, single)
+
+    def test_delta_after_value(self):
+        merged, single = self.flush([(0, 'g:5|g'), (1, 'g:10|g'),
+                                     (0, 'g:+1|g')])
+        self.assertEqual(single, {'g': 11})
+        self.assertEqual(merged, single)
+
+    def test_deltas_without_value(self):
+        merged, single = self.flush([(0, 'g:+2|g'), (1, 'g:-5|g'),
+                                     (0, 'g:+1|g')])
+        self.assertEqual(single, {'g': -2})
+        self.assertEqual(merged, single)
+
+
+class TestWorkerMerge(StatsdTestCase):
+
+    def events(self):
+        lines = []
+        for i in xrange(300):
+            lines.append('hits.%d:%d|c' % (i % 7, i % 5 + 1))
+            lines.append('sampled:1|c|@0.5')
+            lines.append('latency.%d:%d|ms' % (i % 3, (i * 37) % 1000))
+            lines.append('slow:%d|ms|@0.25' % (i % 11))
+            lines.append('users:u%d|s' % (i % 120))
+            lines.append('many:%d|s' % i)
+        return lines
+
+    def payload(self, server):
+        snapshot = server.take_snapshot()
+        snapshot['tstamp'] = 1000000000
+        payload = server.plain_payload(snapshot)
+        return sorted(''.join(batch for batches in payload.itervalues()
+                              for batch in batches).splitlines())
+
+    def check(self, **conf):
+        """Spread events over three workers, and check the coordinator
+        merging their state reports the same as a single process"""
+        lines = self.events()
+        single = self.server(**conf)
+        single.process_batch(lines)
+        coordinator = self.server(**conf)
+        coordinator.gauge_stamps = {}
+        for i in xrange(3):
+            worker = self.server(**conf)
+            worker.gauge_stamps = {}
+            worker.gauge_events = {}
+            worker.process_batch(lines[i::3])
+            # as sent over the control socket
+            state = pickle.loads(pickle.dumps(worker.swap_state(), -1))
+            coordinator.merge_state(state)
+        expected = self.payload(single)
+        self.assertTrue(expected)
+        self.assertEqual(self.payload(coordinator), expected)
+
+    def test_exact(self):
+        self.check()
+
+    def test_sketches_and_hyperloglogs(self):
+        self.check(timer_backend='sketch', set_max_exact='100',
+                   percent_threshold='50,90,99')
+
+
+class TestBatchParser(StatsdTestCase):
+
+    datagrams = [
+        'a:1|c\nb:2|c|@0.1\na:3|c\n',
+        't:10|ms\nt:20|ms|@0.5\nt:5.5|ms\n',
+        'g:10|g\ng:+5|g\ng:-3|g\nh:-2|g\nh:+1|g\ng:7|g',
+        's:x|s\ns:y|s\ns:x|s',
+        'bad\nbad:1\nbad:1|zz\nbad:x|c\nbad:1|ms|@x\n\n',
+        'debug.x:1|c\nweb.host-7.hits:1|c\nweb.host-8.hits:2|c',
+        'key with/odd chars:1|c\nc:1|c|@0.25\nc:2|c|@1',
+    ]
+
+    def state(self, server, parse):
+        # decode_recvd prints what it finds wrong with a line
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            parse(self.datagrams)
+        finally:
+            sys.stdout = stdout
+        return {'counters': server.counters,
+                'timers': dict((key, list(timer)) for key, timer in
+                               server.timers.iteritems()),
+                'sampled_counts': server.sampled_counts,
+                'gauges': server.gauges,
+                'gauge_deltas': server.gauge_deltas,
+                'sets': dict((key, sorted(values.values)) for key, values in
+                             server.sets.iteritems()),
+                'bad_lines': server.bad_lines,
+                'denied': server.denied,
+                'lines_received': server.lines_received,
+                'stats_seen': server.stats_seen}
+
+    def check(self, **conf):
+        batch = self.server(**conf)
+        expected = self.state(batch, batch.process_batch)
+        self.assertTrue(expected['counters'])
+        single = self.server(**conf)
+        self.assertEqual(self.state(single, single.decode_lines), expected)
+
+    def test_same_as_decode_recvd(self):
+        self.check()
+
+    def test_same_with_rules(self):
+        self.check(rules='debug,hosts', rule_debug=r'deny ^debug\.',
+                   rule_hosts=r'rewrite \.host-[0-9]+\. .')
+
+    def test_same_without_key_cache(self):
+        self.check(key_cache_size='0')
+
+
+class TestStateFile(StatsdTestCase):
+
+    def setUp(self):
+        StatsdTestCase.setUp(self)
+        self.path = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.path, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        StatsdTestCase.tearDown(self)
+
+    def payloads(self, server):
+        """The lines of the next flush and of the rollup's window"""
+        snapshot = server.take_snapshot()
+        snapshots = [snapshot] + [rollup.take_snapshot(snapshot['tstamp'])
+                                  for rollup in server.rollups]
+        lines = []
+        for snapshot in snapshots:
+            snapshot['tstamp'] = 1000000000
+            for batches in server.plain_payload(snapshot).itervalues():
+                lines.extend(''.join(batches).splitlines())
+        return sorted(lines)
+
+    def test_round_trip(self):
+        for timer_backend in ('exact', 'sketch'):
+            conf = {'state_file': self.state_file, 'rollups': '30',
+                    'timer_backend': timer_backend}
+            first = [['a:1|c', 't:10|ms', 'g:5|g', 's:x|s'],
+                     ['a:2|c|@0.5', 't:20|ms|@0.5', 'g:+1|g', 's:y|s',
+                      'h:+3|g']]
+            uninterrupted = self.server(**conf)
+            restarted = self.server(**conf)
+            for server in (uninterrupted, restarted):
+                server.process_batch(first[0])
+                server.roll_up(server.take_snapshot())
+                server.process_batch(first[1])
+            self.assertEqual(restarted.final_snapshots(), [])
+            self.assertTrue(os.path.exists(self.state_file))
+            restarted = self.server(**conf)
+            restarted.restore_state()
+            self.assertFalse(os.path.exists(self.state_file))
+            for server in (uninterrupted, restarted):
+                server.process_batch(['a:4|c', 't:30|ms', 's:z|s'])
+            expected = self.payloads(uninterrupted)
+            self.assertTrue([line for line in expected
+                             if line.startswith('rollup30.')])
+            self.assertEqual(self.payloads(restarted), expected)
+
+    def test_stale_state_is_ignored(self):
+        server = self.server(state_file=self.state_file)
+        server.process_batch(['a:1|c'])
+        server.save_state()
+        server = self.server(state_file=self.state_file, state_max_age='0')
+        time.sleep(0.01)
+        server.restore_state()
+        self.assertEqual(server.counters, {})
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_exact_timers_restored_as_sketches(self):
+        server = self.server(state_file=self.state_file)
+        server.process_batch(['t:10|ms', 't:20|ms'])
+        server.save_state()
+        server = self.server(state_file=self.state_file,
+                             timer_backend='sketch')
+        server.restore_state()
+        self.assertEqual(len(server.timers['t']), 2)
+        self.assertEqual(server.timers['t'].max, 20)
+
+
+class TestGauges(StatsdTestCase):
+
+    def test_idle_gauge_keeps_its_value(self):
+        server = self.server()
+        reported = []
+        for lines in (['g:10|g'], [], ['g:+5|g'], [], ['g:-3|g']):
+            server.process_batch(lines)
+            reported.append(server.take_snapshot()['gauges'])
+        self.assertEqual(reported, [{'g': 10}, {'g': 10}, {'g': 15},
+                                    {'g': 15}, {'g': 12}])
+
+    def test_idle_gauge_expires(self):
+        server = self.server(gauge_ttl='1')
+        server.process_batch(['g:10|g'])
+        self.assertEqual(server.take_snapshot()['gauges'], {'g': 10})
+        self.assertEqual(server.take_snapshot()['gauges'], {'g': 10})
+        self.assertEqual(server.take_snapshot()['gauges'], {})
+        # with nothing left to apply it to, a delta starts from 0
+        server.process_batch(['g:+5|g'])
+        self.assertEqual(server.take_snapshot()['gauges'], {'g': 5})
+
+
+class TestReceive(StatsdTestCase):
+
+    def test_error_doesnt_stop_receiving(self):
+        server = self.server()
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(('127.0.0.1', 0))
+        addr = peer.getsockname()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.connect(addr)
+        # nobody listening, the next read off sock gets ECONNREFUSED
+        peer.close()
+        sock.send('ping')
+        eventlet.sleep(0.1)
+        thread = eventlet.spawn(server.receive, sock)
+        eventlet.sleep(0.2)
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(addr)
+        peer.sendto('a:1|c', sock.getsockname())
+        eventlet.sleep(0.2)
+        self.assertEqual(server.counters, {'a': 1})
+        self.assertEqual(server.take_ingest_stats()['recv_errors'], 1)
+        server.stopping = True
+        peer.sendto('a:1|c', sock.getsockname())
+        with eventlet.Timeout(5):
+            thread.wait()
+        peer.close()
+        sock.close()
+
+
+class TestStream(StatsdTestCase):
+
+    def test_rest_of_long_line_is_skipped(self):
+        server = self.server(stream_max_line='10')
+        pending = server.process_stream('', 'a:1|c\nbogus' + 'x' * 20)
+        self.assertEqual(pending, None)
+        pending = server.process_stream(pending, 'x' * 20)
+        self.assertEqual(pending, None)
+        # the end of the long line isn't taken for a metric of its own
+        pending = server.process_stream(pending, 'yyy:1|c\nb:2|c\n')
+        self.assertEqual(pending, '')
+        self.assertEqual(server.counters, {'a': 1, 'b': 2})
+        self.assertEqual(server.bad_lines, {'too_long': 1})
+
+    def test_lines_split_across_reads(self):
+        server = self.server(stream_max_line='10')
+        pending = server.process_stream('', 'a:1|c\nb:')
+        self.assertEqual(pending, 'b:')
+        pending = server.process_stream(pending, '2|c\n')
+        self.assertEqual(pending, '')
+        self.assertEqual(server.counters, {'a': 1, 'b': 2})
+
+
+class TestReload(StatsdTestCase):
+
+    def setUp(self):
+        StatsdTestCase.setUp(self)
+        self.path = tempfile.mkdtemp()
+        self.conf_file = os.path.join(self.path, 'statsdpy.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        StatsdTestCase.tearDown(self)
+
+    def write_conf(self, **conf):
+        conf.setdefault('self_stats', 'no')
+        with open(self.conf_file, 'w') as f:
+            f.write('[main]\n')
+            for option in sorted(conf):
+                f.write('%s = %s\n' % (option, conf[option]))
+        return readconf(self.conf_file, 'main')
+
+    def test_carbon_and_spool_settings(self):
+        server = statsd.StatsdServer(self.write_conf(graphite_timeout='5'))
+        dest = ('127.0.0.1', 2003, None)
+        carbon = server.carbons[dest]
+        self.assertEqual((carbon.timeout, carbon.persistent), (5, True))
+        self.assertEqual(server.spools, {})
+        spool_dir = os.path.join(self.path, 'spool')
+        self.write_conf(graphite_timeout='2', graphite_persistent='no',
+                        spool_dir=spool_dir, spool_max_bytes='4096')
+        server.reload()
+        carbon = server.carbons[dest]
+        self.assertEqual((carbon.timeout, carbon.persistent), (2, False))
+        self.assertEqual(server.spools[dest].path, spool_dir)
+        self.assertEqual(server.spools[dest].max_bytes, 4096)
+        self.assertEqual(server.replaying, set([dest]))
+        # unchanged settings keep the connections and spool
+        spool = server.spools[dest]
+        server.reload()
+        self.assertTrue(server.carbons[dest] is carbon)
+        self.assertTrue(server.spools[dest] is spool)
+        self.write_conf(graphite_timeout='2', graphite_persistent='no')
+        server.reload()
+        self.assertEqual(server.spools, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
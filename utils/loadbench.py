@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Load generation and benchmark harness for statsdpy.
+
+Starts a statsdpy server (bin/statsdpy-server in the foreground) reporting
+to a fake carbon listener run by this script, replays a configurable mix of
+counter, timer, gauge and set traffic at it and prints machine readable (json)
+results:
+
+ - sent/received events and loss, taken from the counter and timer counts
+   statsdpy reported (gauges and sets can't be counted and are left out)
+ - send and sustained ingest rates
+ - duration of every flush, from the first to the last line carbon got
+ - peak and final RSS of the server
+
+Example::
+
+    utils/loadbench.py --duration 30 --keys 10000 --mix c=60,ms=30,g=10 \\
+        --per-packet 20 --set pickle_batch_size=500 --output run.json
+"""
+from ConfigParser import RawConfigParser
+from collections import defaultdict
+import subprocess
+import threading
+import optparse
+import tempfile
+import random
+import socket
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+class FakeCarbon(object):
+    """Plaintext carbon listener recording every line with its arrival time"""
+
+    def __init__(self, port):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+        self.lines = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self._spawn(self.accept)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            conn, addr = self.sock.accept()
+            self.connections += 1
+            self._spawn(self.read, conn)
+
+    def read(self, conn):
+        buf = ''
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return
+            now = time.time()
+            lines = (buf + data).split('\n')
+            buf = lines.pop()
+            with self.lock:
+                self.lines.extend((now, line) for line in lines)
+
+
+def rss_kb(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def start_server(conf, debug):
+    fd, path = tempfile.mkstemp(suffix='.conf')
+    parser = RawConfigParser()
+    parser.add_section('main')
+    for key, value in sorted(conf.items()):
+        parser.set('main', key, value)
+    with os.fdopen(fd, 'w') as f:
+        parser.write(f)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    out = None if debug else open(os.devnull, 'w')
+    proc = subprocess.Popen([sys.executable,
+                             os.path.join(ROOT, 'bin', 'statsdpy-server'),
+                             '--conf=%s' % path, '-f'],
+                            env=env, stdout=out, stderr=out)
+    return proc, path
+
+
+def generate(options, addr, stop_at, rss):
+    """Send events until stop_at, returns the number sent per type"""
+    weights = []
+    for item in options.mix.split(','):
+        kind, weight = item.split('=')
+        weights.extend([kind] * int(weight))
+    keys = options.keys
+    sent = defaultdict(int)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    interval = 1.0 / options.rate if options.rate else 0
+    next_send = time.time()
+    packets = 0
+    while time.time() < stop_at:
+        lines = []
+        for i in xrange(options.per_packet):
+            kind = random.choice(weights)
+            key = random.randint(0, keys - 1)
+            if kind == 'c':
+                lines.append('bench.c.%d:1|c' % key)
+            elif kind == 'ms':
+                lines.append('bench.t.%d:%d|ms' %
+                             (key, random.randint(1, 500)))
+            elif kind == 's':
+                lines.append('bench.s.%d:%d|s' % (key, random.randint(1, 500)))
+            else:
+                lines.append('bench.g.%d:%d|g' % (key, random.randint(1, 500)))
+            sent[kind] += 1
+        try:
+            sock.sendto('\n'.join(lines), addr)
+        except socket.error:
+            sent['send_errors'] += 1
+        packets += 1
+        if not packets % 1000:
+            rss.sample()
+        if interval:
+            next_send += interval
+            delay = next_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    sent['packets'] = packets
+    return sent
+
+
+class RssSampler(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = 0
+        self.last = None
+
+    def sample(self):
+        self.last = rss_kb(self.pid)
+        if self.last > self.peak:
+            self.peak = self.last
+
+
+def summarize(carbon, sent, started, sent_until):
+    counted = {'c': 0, 'ms': 0}
+    flushes = defaultdict(list)
+    with carbon.lock:
+        lines = list(carbon.lines)
+    for arrived, line in lines:
+        try:
+            name, value, tstamp = line.split()
+        except ValueError:
+            continue
+        flushes[tstamp].append(arrived)
+        if name.startswith('stats_counts.bench.c.'):
+            counted['c'] += float(value)
+        elif name.startswith('stats.timers.bench.t.') and \
+                name.endswith('.count'):
+            counted['ms'] += float(value)
+    flush_durations = [max(times) - min(times) for flush, times in
+                       sorted(flushes.items())]
+    countable = sent['c'] + sent['ms']
+    received = counted['c'] + counted['ms']
+    elapsed = sent_until - started
+    return {
+        'sent': dict(sent),
+        'received': counted,
+        'loss': 1 - received / countable if countable else None,
+        'send_rate': sum(sent[k] for k in ('c', 'ms', 'g', 's')) / elapsed,
+        'ingest_rate': received / elapsed,
+        'flushes': len(flush_durations),
+        'flush_duration_max': max(flush_durations or [0]),
+        'flush_duration_avg': (sum(flush_durations) / len(flush_durations)
+                               if flush_durations else 0),
+        'carbon_lines': len(lines),
+        'carbon_connections': carbon.connections,
+    }
+
+
+def main():
+    args = optparse.OptionParser(__doc__.strip().split('\n')[0])
+    args.add_option('--duration', type='float', default=10,
+                    help="seconds to send traffic for")
+    args.add_option('--rate', type='float', default=0,
+                    help="packets per second, 0 for as fast as possible")
+    args.add_option('--keys', type='int', default=1000,
+                    help="number of distinct keys per type")
+    args.add_option('--mix', default='c=70,ms=20,g=10',
+                    help="relative weights of counter, timer, gauge and set "
+                    "events")
+    args.add_option('--per-packet', type='int', default=10,
+                    help="events packed into each datagram")
+    args.add_option('--port', type='int', default=18125,
+                    help="udp port for the server to listen on")
+    args.add_option('--flush-interval', type='int', default=2)
+    args.add_option('--set', action='append', default=[],
+                    help="extra server config option as key=value")
+    args.add_option('--seed', type='int', default=1)
+    args.add_option('--output', help="write the json results here")
+    args.add_option('--debug', action='store_true',
+                    help="show the server's output")
+    options, arguments = args.parse_args()
+    random.seed(options.seed)
+
+    carbon = FakeCarbon(0)
+    conf = {'listen_addr': '127.0.0.1',
+            'listen_port': str(options.port),
+            'graphite_host': '127.0.0.1',
+            'graphite_port': str(carbon.port),
+            'pickle_protocol': 'no',
+            'legacy_namespace': 'yes',
+            'flush_interval': str(options.flush_interval)}
+    for item in options.set:
+        key, value = item.split('=', 1)
+        conf[key.strip()] = value.strip()
+    proc, conf_path = start_server(conf, options.debug)
+    try:
+        time.sleep(1)
+        if proc.poll() is not None:
+            sys.exit("statsdpy-server exited with %s" % proc.returncode)
+        rss = RssSampler(proc.pid)
+        rss.sample()
+        rss_idle = rss.last
+        started = time.time()
+        sent = generate(options, ('127.0.0.1', options.port),
+                        started + options.duration, rss)
+        sent_until = time.time()
+        # give the server a couple of flushes to report everything
+        time.sleep(options.flush_interval * 2 + 1)
+        rss.sample()
+        results = summarize(carbon, sent, started, sent_until)
+        results.update({'rss_idle_kb': rss_idle, 'rss_peak_kb': rss.peak,
+                        'rss_final_kb': rss.last,
+                        'options': dict(vars(options)), 'config': conf})
+    finally:
+        # it may have exited already, see above
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+        os.unlink(conf_path)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the event parser: lines/sec of the batch parser
+(process_batch) against decoding every line with decode_recvd.
+"""
+from statsdpy.statsd import StatsdServer
+import optparse
+import random
+import time
+
+
+def make_datagrams(lines, keys, per_packet):
+    events = []
+    for i in xrange(lines):
+        key = 'bench.key%d' % random.randint(0, keys - 1)
+        kind = random.choice(('c', 'c|@0.1', 'ms', 'ms|@0.5', 'g'))
+        events.append('%s:%d|%s' % (key, random.randint(1, 500), kind))
+    return ['\n'.join(events[i:i + per_packet])
+            for i in xrange(0, lines, per_packet)]
+
+
+def bench(name, func, datagrams, lines):
+    start = time.time()
+    func(datagrams)
+    elapsed = time.time() - start
+    print "%-14s %8.3fs %12.0f lines/sec" % (name, elapsed, lines / elapsed)
+
+
+if __name__ == '__main__':
+    args = optparse.OptionParser('%prog [options]')
+    args.add_option('--lines', type='int', default=500000)
+    args.add_option('--keys', type='int', default=2000)
+    args.add_option('--per-packet', type='int', default=10)
+    options, arguments = args.parse_args()
+
+    datagrams = make_datagrams(options.lines, options.keys,
+                               options.per_packet)
+    print "%d lines, %d keys, %d lines per packet" % \
+        (options.lines, options.keys, options.per_packet)
+    bench('decode_recvd', StatsdServer({}).decode_lines, datagrams,
+          options.lines)
+    bench('process_batch', StatsdServer({}).process_batch, datagrams,
+          options.lines)